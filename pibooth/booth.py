@@ -5,25 +5,29 @@
 """
 
 import os
-import subprocess
+import math
 import time
-import shutil
 import logging
 import pygame
 import argparse
 import os.path as osp
 from RPi import GPIO
-from PIL import Image
 import pibooth
+from pibooth import fonts
+from pibooth.pictures import qr, layout
 from pibooth.utils import LOGGER, timeit, PoolingTimer, configure_logging
 from pibooth.states import StateMachine, State
+from pibooth.runtime import ThreadsRuntime
+from pibooth.store import SessionStore, SessionCleaner, clear_directory
 from pibooth.view import PtbWindow
 from pibooth.config import PiConfigParser
 from pibooth.controls import camera
-from pibooth.pictures.concatenate import concatenate_pictures
+from pibooth.pictures.concatenate import IncrementalCompositor
+from pibooth.pictures.pool import PicturesPool
 from pibooth.controls.light import PtbLed
 from pibooth.controls.button import BUTTON_DOWN, PtbButton
-from pibooth.controls.printer import PtbPrinter
+from pibooth.controls.printer import PtbPrinter, PrintScheduler
+from pibooth.controls.uploader import PtbUploader, UploadJournal
 
 
 class StateFailSafe(State):
@@ -33,9 +37,11 @@ class StateFailSafe(State):
         self.timer = PoolingTimer(timeout)
 
     def entry_actions(self):
-        self.app.dirname = None
+        self.app.session_id = None
         self.app.nbr_captures = None
         self.app.nbr_printed = 0
+        self.app.compositor = None
+        self.app.capture_jobs = []
         self.app.camera.drop_captures()  # Flush previous captures
         self.app.window.show_oops()
         self.timer.start()
@@ -44,71 +50,68 @@ class StateFailSafe(State):
         if self.timer.is_timeout():
             return 'wait'
 
+    def get_timeout(self):
+        return self.timer.remaining()
+
 
 class StateWait(State):
 
     def __init__(self):
         State.__init__(self, 'wait')
+        self.print_job = None
+        self.busy_timer = PoolingTimer(5, start=False)
+        self.busy = False
 
-    def entry_actions(self):
-        #self.app.previous_picture = pibooth.pictures.get_image("~/qrcode.png")
-
-        #self.app.previous_picture = Image.open("/home/pi/qrcode.png")
-
-        qr_image = Image.open("/home/pi/qrcode.png")
-        LOGGER.info("QR image mode: " + qr_image.mode)
-        if qr_image.mode != 'RGB':
-            if qr_image.mode == 'I':
-                from PIL import ImageMath
-                qr_image = ImageMath.eval('im/256', {'im': qr_image})
-            if qr_image.mode == 'P':
-                qr_image = qr_image.convert('RGBA')
-            else:
-                qr_image = qr_image.convert('RGB')
-
-        self.app.previous_picture = qr_image
-
-
-#        self.app.window.show_finished_qr()
-
-        self.app.window.show_intro(self.app.previous_picture, self.app.printer.is_installed() and
-                                   self.app.nbr_printed < self.app.config.getint('PRINTER', 'max_duplicates'))
-#        self.app.window.show_intro(im, 0)
-
+    def show_intro(self):
+        # Show the QR code to get the previous picture (if any)
+        self.app.window.show_intro(self.app.previous_qrcode or self.app.previous_picture,
+                                   self.app.printer.is_installed() and
+                                   self.app.nbr_printed < self.app.config.getint('PRINTER', 'max_duplicates'),
+                                   sharp=self.app.previous_qrcode is not None)
 
+    def entry_actions(self):
+        self.busy = False
+        self.show_intro()
         self.app.led_picture.blink()
         if self.app.previous_picture_file and self.app.printer.is_installed():
             self.app.led_print.blink()
 
-        #pr
-#        LOGGER.debug("Now upload and show QR")
-#        if self.app.previous_picture_file:
-#
-#            LOGGER.debug("Show QR Code for " + self.app.previous_picture_file)
-#            cmd = "bash ~/pibooth/qrcode.sh " + os.path.relpath(self.app.previous_picture_file, "/home/pi/Pictures/pibooth/") 
-#            os.system(cmd)
-
-            #self.app.window.show_finished_qr()
-
     def do_actions(self, events):
+        if self.print_job and self.print_job.done():
+            self.print_job.result()  # Raise the exception (if any) which occurred while printing
+            self.print_job = None
+            self.app.led_print.blink()
 
-        if self.app.find_print_event(events) and self.app.previous_picture_file and self.app.printer.is_installed():
+        if self.busy and self.busy_timer.is_timeout():
+            self.busy = False
+            self.show_intro()
+
+        if self.app.find_print_event(events) and self.app.previous_picture_file and self.app.printer.is_installed()\
+                and not self.print_job:
 
             if self.app.nbr_printed >= self.app.config.getint('PRINTER', 'max_duplicates'):
                 LOGGER.warning("Too many duplicates sent to the printer (%s max)",
                                self.app.config.getint('PRINTER', 'max_duplicates'))
-                self.app.window.show_intro(self.app.previous_picture, False)
+                self.app.window.show_intro(self.app.previous_qrcode or self.app.previous_picture, False,
+                                           sharp=self.app.previous_qrcode is not None)
                 self.app.led_print.switch_off()
                 return
 
-            with timeit("Send final picture to printer"):
-                self.app.led_print.switch_on()
-                self.app.printer.print_file(self.app.previous_picture_file,
-                                            self.app.config.getint('PRINTER', 'nbr_copies'))
+            LOGGER.info("Send final picture to printer")
+            self.print_job = self.app.print_scheduler.request(self.app.previous_picture_file,
+                                                              self.app.config.getint('PRINTER', 'nbr_copies'))
+            if self.print_job is None:
+                # Estimated waiting time too long, try again later
+                self.app.window.show_print(self.app.previous_picture,
+                                           self.app.print_scheduler.get_queue_depth(), busy=True)
+                self.busy_timer.start()
+                self.busy = True
+                return
 
-            time.sleep(2)  # Just to let the LED switched on
+            self.app.led_print.switch_on()  # Until the picture is sent
+            self.app.runtime.watch_future(self.print_job)
             self.app.nbr_printed += 1
-            self.app.led_print.blink()
+            self.app.store.update(self.app.session_id, printed=self.app.nbr_printed)
 
     def exit_actions(self):
         self.app.led_picture.switch_off()
@@ -125,6 +128,11 @@ class StateWait(State):
                 self.app.nbr_captures = self.app.capt_choices[0]
                 return 'capture'
 
+    def get_timeout(self):
+        if self.busy:
+            return self.busy_timer.remaining()
+        return None  # Nothing to do until an event is received (or the print job is done)
+
 
 class StateChoose(State):
 
@@ -165,6 +173,9 @@ class StateChoose(State):
         elif self.timer.is_timeout():
             return 'wait'
 
+    def get_timeout(self):
+        return self.timer.remaining()
+
 
 class StateChosen(State):
 
@@ -185,6 +196,9 @@ class StateChosen(State):
         if self.timer.is_timeout():
             return 'capture'
 
+    def get_timeout(self):
+        return self.timer.remaining()
+
 
 class StateCapture(State):
 
@@ -196,26 +210,46 @@ class StateCapture(State):
         LOGGER.info("Start new pictures sequence")
         self.app.nbr_printed = 0
         self.app.previous_picture = None
+        self.app.previous_qrcode = None
         self.app.previous_picture_file = None
-        self.app.dirname = osp.join(self.app.savedir, time.strftime("%y%m%d%H%M"))
-        #self.app.dirname = osp.join(self.app.savedir, time.strftime("%Y-%m-%d-%H-%M"))
-        os.makedirs(self.app.dirname)
+        self.app.session_id = self.app.store.create()
         self.app.led_preview.switch_on()
 
+        footer_texts = [self.app.config.get('PICTURE', 'footer_text1'),
+                        self.app.config.get('PICTURE', 'footer_text2')]
+        bg_color = self.app.config.gettyped('PICTURE', 'bg_color')
+        if not isinstance(bg_color, (tuple, list)):
+            # Path to a background image
+            bg_color = self.app.config.getpath('PICTURE', 'bg_color')
+        text_color = self.app.config.gettyped('PICTURE', 'text_color')
+        orientation = self.app.config.get('PICTURE', 'orientation')
+
+        # Each capture is placed in the final picture by the pictures pool
+        # while the next one is taken
+        self.app.compositor = IncrementalCompositor(self.app.nbr_captures, footer_texts, bg_color,
+                                                    text_color, orientation)
+        self.app.capture_jobs = []
+
         self.count = 0
-        self.app.window.set_picture_number(self.count, self.app.nbr_captures)
         self.app.camera.preview(self.app.window)
+        self.start_countdown()
 
-    def do_actions(self, events):
+    def start_countdown(self):
+        """Show the number of the next capture and start the delay before
+        taking it. The delay is not blocking: the main loop continues to
+        process the events and to refresh the preview.
+        """
         self.app.window.set_picture_number(self.count + 1, self.app.nbr_captures)
-        pygame.event.pump()
-
         if self.app.config.getboolean('WINDOW', 'preview_countdown'):
-            self.app.camera.preview_countdown(self.app.config.getint('WINDOW', 'preview_delay'))
+            self.app.camera.start_preview_timer(self.app.config.getint('WINDOW', 'preview_delay'), alpha=60)
         else:
-            self.app.camera.preview_wait(self.app.config.getint('WINDOW', 'preview_delay'))
+            self.app.camera.start_preview_timer(self.app.config.getint('WINDOW', 'preview_delay'))
+
+    def do_actions(self, events):
+        if self.count >= self.app.nbr_captures or not self.app.camera.update_preview():
+            return  # Sequence finished or delay not elapsed
 
-        capture_path = osp.join(self.app.dirname, "pibooth{:03}.jpg".format(self.count))
+        capture_path = self.app.store.get_capture_filename(self.app.session_id, self.count)
 
         if self.app.config.getboolean('WINDOW', 'preview_stop_on_capture'):
             self.app.camera.stop_preview()
@@ -227,96 +261,195 @@ class StateCapture(State):
             else:
                 self.app.camera.capture(capture_path)
 
+        self.app.capture_jobs.append(self.app.pictures_pool.submit(self.add_capture, self.app.compositor,
+                                                                   capture_path, self.count))
         self.count += 1
 
         if self.app.config.getboolean('WINDOW', 'preview_stop_on_capture') and self.count < self.app.nbr_captures:
             # Restart preview only if other captures needed
             self.app.camera.preview(self.app.window)
 
+        if self.count < self.app.nbr_captures:
+            self.start_countdown()
+
+    def add_capture(self, compositor, capture_path, index):
+        """Post-process the capture and place it in the final picture
+        (executed in the pictures pool).
+        """
+        # No timeit block in the pool threads, the log blocks are shared
+        # by all threads
+        start = time.time()
+        compositor.add_picture(self.app.camera.get_capture(capture_path), index)
+        LOGGER.info("Capture %s placed in the final picture (took %0.3f seconds)", capture_path, time.time() - start)
+
     def exit_actions(self):
         self.app.camera.stop_preview()
         self.app.led_preview.switch_off()
+        self.app.store.update(self.app.session_id, captures=self.count)
 
     def validate_transition(self, events):
         if self.count >= self.app.nbr_captures:
             return 'processing'
 
+    def get_timeout(self):
+        if self.count >= self.app.nbr_captures:
+            return 0
+        return self.app.camera.get_preview_timeout()
+
 
 class StateProcessing(State):
 
     def __init__(self):
         State.__init__(self, 'processing')
+        self.timer = PoolingTimer(0.5)
+        self.future = None
+        self.qr_future = None
+        self.step = 0
 
     def entry_actions(self):
-        self.app.window.show_work_in_progress()
+        self.step = 0
+        self.app.window.show_work_in_progress(self.step)
 
-        with timeit("Creating merged picture"):
-            footer_texts = [self.app.config.get('PICTURE', 'footer_text1'),
-                            self.app.config.get('PICTURE', 'footer_text2')]
-            bg_color = self.app.config.gettyped('PICTURE', 'bg_color')
-            if not isinstance(bg_color, (tuple, list)):
-                # Path to a background image
-                bg_color = Image.open(self.app.config.getpath('PICTURE', 'bg_color'))
-            text_color = self.app.config.gettyped('PICTURE', 'text_color')
-            orientation = self.app.config.get('PICTURE', 'orientation')
+        self.app.previous_picture = None
+        self.app.previous_picture_file = self.app.store.get_picture_filename(self.app.session_id)
+
+        # The final picture is built by the pool, the main loop continues to
+        # process the events and to animate the view
+        self.future = self.app.pictures_pool.submit(self.build_picture, self.app.compositor,
+                                                    self.app.capture_jobs, self.app.previous_picture_file)
+        self.app.runtime.watch_future(self.future)
+
+        # The QR code is generated while the picture is built and saved
+        self.qr_future = None
+        url = self.app.uploader.get_share_url(self.app.previous_picture_file)
+        if url and qr.is_available():
+            # One pixel per module, scaled by the view to fit the window
+            self.qr_future = self.app.pictures_pool.submit(qr.get_qrcode, url, 1)
+            self.app.runtime.watch_future(self.qr_future)
+        self.timer.start()
 
-            self.app.previous_picture = concatenate_pictures(
-                self.app.camera.get_captures(), footer_texts, bg_color, text_color, orientation)
+    def build_picture(self, compositor, capture_jobs, filename):
+        """Finalize the picture built from the captures and save it (executed
+        in the pictures pool after the captures placement).
+        """
+        start = time.time()
+        self.app.pictures_pool.wait(capture_jobs)
+        placed = time.time()
+        picture = compositor.build()
+        built = time.time()
+        picture.save(filename)
+        LOGGER.info("Merged picture saved in %s (took %0.3f seconds: captures placement %0.3f, "
+                    "build %0.3f, save %0.3f)", filename, time.time() - start, placed - start,
+                    built - placed, time.time() - built)
+        return picture
 
+    def do_actions(self, events):
+        if self.timer.is_timeout():
+            self.step += 1
+            self.app.window.show_work_in_progress(self.step)
+            self.timer.start()
 
-        self.app.previous_picture_file = osp.join(self.app.dirname, time.strftime("%y%m%d%H%M") + ".jpg")
-        #self.app.previous_picture_file = osp.join(self.app.dirname, time.strftime("%Y-%m-%d-%H-%M") + ".jpg")
-        # pr
+    def validate_transition(self, events):
+        if not self.future.done() or (self.qr_future and not self.qr_future.done()):
+            return None
 
-        LOGGER.info("Show QR Code for " + self.app.previous_picture_file)
-        cmd = "bash ~/pibooth/qrcode.sh " + os.path.relpath(self.app.previous_picture_file, "/home/pi/Pictures/pibooth/") 
-        os.system(cmd)
+        # Raise the exception (if any) which occurred in the pool
+        self.app.previous_picture = self.future.result()
 
+        if self.qr_future:
+            try:
+                self.app.previous_qrcode = self.qr_future.result()
+            except Exception:
+                pass  # Already logged by the pool, the QR code is not mandatory
 
-        #LOGGER.debug("generate qrcode")
-        #cmd = "qr " + self.app.previous_picture_file + " > ~/qrcode.png"
-        #os.system(cmd)
-        with timeit("Save the merged picture in {}".format(self.app.previous_picture_file)):
-            self.app.previous_picture.save(self.app.previous_picture_file)
+        # Render the sheet to print before any request (the print view is
+        # displayed meanwhile)
+        self.app.printer.prepare(self.app.previous_picture_file, self.app.previous_picture,
+                                 self.app.config.getint('PRINTER', 'nbr_copies'))
 
-    def validate_transition(self, events):
         if self.app.printer.is_installed() and self.app.config.getfloat('PRINTER', 'printer_delay') > 0:
             return 'print'
         else:
             return 'finish'  # Can not print
 
+    def get_timeout(self):
+        return self.timer.remaining()  # Waked up when the picture is ready
+
 
 class StatePrint(State):
 
     def __init__(self):
         State.__init__(self, 'print')
         self.timer = PoolingTimer(self.app.config.getfloat('PRINTER', 'printer_delay'))
-        self.printed = False
+        self.print_timer = PoolingTimer(self.app.config.getfloat('PRINTER', 'print_timeout'), start=False)
+        self.refresh_timer = PoolingTimer(2, start=False)
+        self.print_job = None
+        self.job_id = None
+        self.queue_depth = None
+        self.rejected = False
 
     def entry_actions(self):
-        self.printed = False
+        self.print_job = None
+        self.job_id = None
+        self.queue_depth = None
+        self.rejected = False
         with timeit("Display the merged picture"):
             self.app.window.show_print(self.app.previous_picture)
         self.app.led_print.blink()
         self.timer.start()
 
     def do_actions(self, events):
-        if self.app.find_print_event(events) and self.app.previous_picture_file:
-
-            with timeit("Send final picture to printer"):
-                self.app.led_print.switch_on()
-                self.app.printer.print_file(self.app.previous_picture_file,
-                                            self.app.config.getint('PRINTER', 'nbr_copies'))
+        if self.print_job:
+            if self.job_id is None and self.print_job.done():
+                self.job_id = self.print_job.result()  # Raise the exception (if any) which occurred while printing
+
+            if self.refresh_timer.is_timeout():
+                # In case of lost CUPS notifications
+                self.app.printer.refresh()
+                self.refresh_timer.start()
+
+            queue_depth = self.app.print_scheduler.get_queue_depth()
+            if queue_depth != self.queue_depth:
+                self.queue_depth = queue_depth
+                self.app.window.show_print(self.app.previous_picture, self.queue_depth)
+
+        elif self.app.find_print_event(events) and self.app.previous_picture_file and not self.rejected:
+            # Queued, the sheet is certainly already rendered
+            LOGGER.info("Send final picture to printer")
+            self.print_job = self.app.print_scheduler.request(self.app.previous_picture_file,
+                                                              self.app.config.getint('PRINTER', 'nbr_copies'))
+            if self.print_job is None:
+                # Estimated waiting time too long, show it until the end of the print view
+                self.rejected = True
+                self.app.window.show_print(self.app.previous_picture,
+                                           self.app.print_scheduler.get_queue_depth(), busy=True)
+                self.app.led_print.switch_off()
+                self.timer.start()
+                return
 
-            time.sleep(2)  # Just to let the LED switched on
+            self.app.runtime.watch_future(self.print_job)
+            self.app.led_print.switch_on()
             self.app.nbr_printed += 1
-            self.app.led_print.blink()
-            self.printed = True
+            self.app.store.update(self.app.session_id, printed=self.app.nbr_printed)
+            self.print_timer.start()
+            self.refresh_timer.start()
 
     def validate_transition(self, events):
-        if self.timer.is_timeout() or self.printed:
+        if not self.print_job:
+            if self.timer.is_timeout():
+                return 'finish'
+        elif self.job_id is not None and self.app.printer.is_job_finished(self.job_id):
+            return 'finish'
+        elif self.print_timer.is_timeout():
+            LOGGER.warning("Print job %s not finished after %ss (%s)", self.job_id, self.print_timer.timeout,
+                           self.app.printer.get_job_state(self.job_id))
             return 'finish'
 
+    def get_timeout(self):
+        if self.print_job:
+            return 0.5  # Check the job state
+        return self.timer.remaining()
+
 
 class StateFinish(State):
 
@@ -325,9 +458,12 @@ class StateFinish(State):
         self.timer = PoolingTimer(timeout)
 
     def entry_actions(self):
-        LOGGER.info("Upload to webspace " + self.app.previous_picture_file)
-        cmd= "bash ~/pibooth/upload-file.sh " + os.path.relpath(self.app.previous_picture_file, "/home/pi/Pictures/pibooth/")
-        self.upload_process = subprocess.Popen(cmd, shell=True)
+        if self.app.uploader.is_enabled():
+            LOGGER.info("Upload to webspace %s", self.app.previous_picture_file)
+            # Recorded before queuing, the upload may end before returning
+            self.app.store.update(self.app.session_id, uploaded=False)
+            self.app.uploader.upload(self.app.previous_picture_file)
+        self.app.cleaner.add_session(self.app.session_id)
 
         self.app.window.show_finished()
 
@@ -337,6 +473,43 @@ class StateFinish(State):
         if self.timer.is_timeout():
             return 'wait'
 
+    def get_timeout(self):
+        return self.timer.remaining()
+
+
+class PtbEvents(list):
+
+    """List of the pygame events (most recent first) indexed by type, key
+    and pin in a single pass to avoid scanning the whole list for each
+    lookup.
+    """
+
+    def __init__(self, events=()):
+        list.__init__(self, events)
+        self._index = {}
+        for event in self:
+            self._index.setdefault(event.type, []).append(event)
+            if event.type == pygame.KEYDOWN:
+                self._index.setdefault((event.type, event.key), []).append(event)
+            elif event.type == BUTTON_DOWN:
+                self._index.setdefault((event.type, event.pin), []).append(event)
+
+    def find_all(self, event_type, key=None):
+        """Return the events of the given type (filtered on the key for
+        keyboard events and on the pin for buttons events if given).
+        """
+        if key is None:
+            return self._index.get(event_type, [])
+        return self._index.get((event_type, key), [])
+
+    def find(self, event_type, key=None):
+        """Return the most recent event of the given type (filtered on the
+        key for keyboard events and on the pin for buttons events if given),
+        None if not found.
+        """
+        events = self.find_all(event_type, key)
+        return events[0] if events else None
+
 
 class PiApplication(object):
 
@@ -347,9 +520,24 @@ class PiApplication(object):
         self.savedir = config.getpath('GENERAL', 'directory')
         if not osp.isdir(self.savedir):
             os.makedirs(self.savedir)
+        journal = osp.join(osp.dirname(config.filename), 'uploads.journal')
         if osp.isdir(self.savedir) and config.getboolean('GENERAL', 'clear_on_startup'):
-            shutil.rmtree(self.savedir)
-            os.makedirs(self.savedir)
+            # The pictures waiting to be uploaded shall not be removed
+            prefix = osp.join(osp.abspath(self.savedir), '')
+            pending = [path for _job_id, path, _name in UploadJournal(journal).load()
+                       if path.startswith(prefix)] if config.get('UPLOAD', 'url') else []
+            if pending:
+                LOGGER.warning("Directory '%s' not cleared, %s picture(s) waiting to be uploaded",
+                               self.savedir, len(pending))
+            else:
+                clear_directory(self.savedir)  # Removed in background by the cleaner
+        self.store = SessionStore(self.savedir)
+        self.cleaner = SessionCleaner(self.store,
+                                      config.getint('GENERAL', 'keep_sessions'),
+                                      config.getfloat('GENERAL', 'max_disk_usage') * 1024 * 1024,
+                                      config.getboolean('GENERAL', 'keep_only_finals'),
+                                      config.get('GENERAL', 'archive_directory') and
+                                      config.getpath('GENERAL', 'archive_directory'))
 
         # Prepare GPIO, physical pins mode
         GPIO.setmode(GPIO.BOARD)
@@ -387,7 +575,9 @@ class PiApplication(object):
         self.camera = cam_class(config.getint('CAMERA', 'iso'),
                                 config.gettyped('CAMERA', 'resolution'),
                                 config.getint('CAMERA', 'rotation'),
-                                config.getboolean('CAMERA', 'flip'))
+                                config.getboolean('CAMERA', 'flip'),
+                                config.getboolean('CAMERA', 'save_captures'),
+                                config.getboolean('CAMERA', 'capture_to_ram'))
 
         self.led_picture = PtbLed(config.getint('CONTROLS', 'picture_led_pin'))
         self.button_picture = PtbButton(config.getint('CONTROLS', 'picture_btn_pin'),
@@ -400,128 +590,179 @@ class PiApplication(object):
         self.led_startup = PtbLed(config.getint('CONTROLS', 'startup_led_pin'))
         self.led_preview = PtbLed(config.getint('CONTROLS', 'preview_led_pin'))
 
-        self.printer = PtbPrinter(config.get('PRINTER', 'printer_name'))
+        self.printer = PtbPrinter(config.get('PRINTER', 'printer_name'),
+                                  config.getfloat('PRINTER', 'page_time'))
+        self.print_scheduler = PrintScheduler(self.printer,
+                                              config.getint('PRINTER', 'max_jobs'),
+                                              config.getfloat('PRINTER', 'max_wait'))
+
+        self.pictures_pool = PicturesPool()
+
+        self.uploader = PtbUploader(config.get('UPLOAD', 'url'),
+                                    journal,
+                                    self.savedir,
+                                    config.getint('UPLOAD', 'max_uploads'),
+                                    config.getfloat('UPLOAD', 'retry_delay'),
+                                    share_url=config.get('UPLOAD', 'share_url'))
+        self.uploader.add_callback(self._on_uploaded)
+        if self.uploader.get_share_url(self.savedir) and not qr.is_available():
+            LOGGER.warning("QR codes of the pictures will not be shown (qrcode not installed)")
+
+        # Main loop and slow I/O operations (printing...) management
+        self.runtime = ThreadsRuntime()
 
         # Variables shared between states
-        self.dirname = None
+        self.session_id = None
         self.nbr_captures = None
         self.nbr_printed = 0
+        self.compositor = None
+        self.capture_jobs = []
         self.previous_picture = None
+        self.previous_qrcode = None
         self.previous_picture_file = None
 
         self.capt_choices = config.gettyped('PICTURE', 'captures')
         if isinstance(self.capt_choices, int):
             self.capt_choices = (self.capt_choices,)
+        # The captures numbers shall be supported by the layouts which may
+        # be used (orientation determined from the captures if automatic)
+        orientation = config.get('PICTURE', 'orientation')
+        if orientation in ('auto', 'revauto'):
+            names = ('portrait', 'landscape')
+        else:
+            names = (orientation,)
+        supported = sorted(set.intersection(*[set(layout.get_supported_captures(name)) for name in names]))
         for chx in self.capt_choices:
-            if chx not in [1, 2, 3, 4]:
-                raise ValueError("Invalid captures number '{}'".format(chx))
+            if chx not in supported:
+                raise ValueError("Invalid captures number '{}' (supported: {})".format(chx, supported))
 
-    def find_quit_event(self, events):
-        """Return the first found event if found in the list.
+    def _on_uploaded(self, filename):
+        """Record the upload of a final picture in the sessions index (called
+        from the upload threads).
+        """
+        session_id = self.store.find(filename)
+        if session_id is not None:
+            self.store.update(session_id, uploaded=True)
+            self.cleaner.refresh()
+
+    def wait_events(self, timeout=None):
+        """Wait until at least one event is received or the timeout (in
+        seconds) is reached, then return all events, most recent first.
+        The queue is only pooled if the timeout is 0 (or if pygame is too
+        old to wait with a timeout).
+        """
+        if timeout == 0 or pygame.version.vernum[0] < 2:
+            events = pygame.event.get()
+        elif timeout is None:
+            events = [pygame.event.wait()] + pygame.event.get()
+        else:
+            events = [pygame.event.wait(max(1, int(math.ceil(timeout * 1000))))] + pygame.event.get()
+        return PtbEvents(event for event in reversed(events) if event.type != pygame.NOEVENT)
+
+    def find_click_event(self, events, left=True):
+        """Return the most recent mouse click event on the left (or right)
+        half of the window.
         """
-        for event in events:
-            if event.type == pygame.QUIT or\
-                    (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+        rect = self.window.get_rect()
+        if left:
+            area = pygame.Rect(0, 0, rect.width // 2, rect.height)
+        else:
+            area = pygame.Rect(rect.width // 2, 0, rect.width // 2, rect.height)
+        for event in events.find_all(pygame.MOUSEBUTTONUP):
+            if area.collidepoint(event.pos):
                 return event
         return None
 
+    def find_quit_event(self, events):
+        """Return the first found event if found in the list.
+        """
+        return events.find(pygame.QUIT) or events.find(pygame.KEYDOWN, pygame.K_ESCAPE)
+
     def find_fullscreen_event(self, events):
         """Return the first found event if found in the list.
         """
-        for event in events:
-            if  event.type == pygame.KEYDOWN and\
-                    event.key == pygame.K_f and pygame.key.get_mods() & pygame.KMOD_CTRL:
+        for event in events.find_all(pygame.KEYDOWN, pygame.K_f):
+            if event.mod & pygame.KMOD_CTRL:
                 return event
         return None
 
     def find_resize_event(self, events):
         """Return the first found event if found in the list.
         """
-        for event in events:
-            if event.type == pygame.VIDEORESIZE:
-                return event
-        return None
+        return events.find(pygame.VIDEORESIZE)
 
     def find_picture_event(self, events):
         """Return the first found event if found in the list.
         """
-        for event in events:
-            if (event.type == pygame.KEYDOWN and event.key == pygame.K_p) or \
-                    (event.type == BUTTON_DOWN and event.pin == self.button_picture):
-                return event
-            elif event.type == pygame.MOUSEBUTTONUP:
-                rect = self.window.get_rect()
-                if pygame.Rect(0, 0, rect.width // 2, rect.height).collidepoint(event.pos):
-                    return event
-        return None
+        return events.find(pygame.KEYDOWN, pygame.K_p) or \
+            events.find(BUTTON_DOWN, self.button_picture.pin) or \
+            self.find_click_event(events, left=True)
 
     def find_print_event(self, events):
         """Return the first found event if found in the list.
         """
-        for event in events:
-            if (event.type == pygame.KEYDOWN and event.key == pygame.K_e and
-                    pygame.key.get_mods() & pygame.KMOD_CTRL) or \
-                    (event.type == BUTTON_DOWN and event.pin == self.button_print):
+        for event in events.find_all(pygame.KEYDOWN, pygame.K_e):
+            if event.mod & pygame.KMOD_CTRL:
                 return event
-            elif event.type == pygame.MOUSEBUTTONUP:
-                rect = self.window.get_rect()
-                if pygame.Rect(rect.width // 2, 0, rect.width // 2, rect.height).collidepoint(event.pos):
-                    return event
-        return None
+        return events.find(BUTTON_DOWN, self.button_print.pin) or \
+            self.find_click_event(events, left=False)
 
     def find_choice_event(self, events):
         """Return the first found event if found in the list.
         """
-        for event in events:
-            if (event.type == pygame.KEYDOWN and event.key == pygame.K_LEFT) or \
-                    (event.type == BUTTON_DOWN and event.pin == self.button_picture):
-                event.key = pygame.K_LEFT
-                return event
-            elif (event.type == pygame.KEYDOWN and event.key == pygame.K_RIGHT) or \
-                    (event.type == BUTTON_DOWN and event.pin == self.button_print):
-                event.key = pygame.K_RIGHT
-                return event
-            elif event.type == pygame.MOUSEBUTTONUP:
-                rect = self.window.get_rect()
-                if pygame.Rect(0, 0, rect.width // 2, rect.height).collidepoint(event.pos):
-                    event.key = pygame.K_LEFT
-                else:
-                    event.key = pygame.K_RIGHT
-                return event
+        event = events.find(pygame.KEYDOWN, pygame.K_LEFT) or \
+            events.find(BUTTON_DOWN, self.button_picture.pin) or \
+            self.find_click_event(events, left=True)
+        if event:
+            event.key = pygame.K_LEFT
+            return event
+
+        event = events.find(pygame.KEYDOWN, pygame.K_RIGHT) or \
+            events.find(BUTTON_DOWN, self.button_print.pin) or \
+            self.find_click_event(events, left=False)
+        if event:
+            event.key = pygame.K_RIGHT
+            return event
         return None
 
+    def process_events(self, events):
+        """Process the events (one iteration of the main loop). Return False
+        if the application shall quit.
+        """
+        if self.find_quit_event(events):
+            return False
+
+        if self.find_fullscreen_event(events):
+            self.window.toggle_fullscreen()
+
+        event = self.find_resize_event(events)
+        if event:
+            self.window.resize(event.size)
+
+        self.state_machine.process(events)
+        return True
+
     def main_loop(self):
         """Run the main game loop.
         """
         try:
             self.led_startup.switch_on()
             self.state_machine.set_state('wait')
-            clock = pygame.time.Clock()
-
-            while True:
-                events = list(reversed(pygame.event.get()))  # Take all events, most recent first
-
-                if self.find_quit_event(events):
-                    break
-
-                if self.find_fullscreen_event(events):
-                    self.window.toggle_fullscreen()
-
-                event = self.find_resize_event(events)
-                if event:
-                    self.window.resize(event.size)
-
-                self.state_machine.process(events)
-                clock.tick(40)  # Ensure the program will never run at more than x frames per second
+            self.runtime.run(self)
 
         finally:
+            LOGGER.debug("Fonts cache usage: %s", fonts.get_cache_info())
             self.led_startup.quit()
             self.led_preview.quit()
             self.led_picture.quit()
             self.led_print.quit()
             GPIO.cleanup()
+            self.pictures_pool.quit()
+            self.runtime.quit()
             self.camera.quit()
             self.printer.quit()
+            self.uploader.quit()
+            self.cleaner.quit()
             pygame.quit()
 
 
@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 
 import io
-import os
+import math
 import time
-import signal
+import threading
 import subprocess
+from collections import OrderedDict as odict
+from concurrent import futures
 import pygame
 import picamera
 try:
     import gphoto2 as gp
 except ImportError:
     gp = None  # gphoto2 is optional
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 from pibooth import fonts
+from pibooth import pictures
 from pibooth.pictures import sizing
-from pibooth.utils import LOGGER, PoolingTimer, timeit
+from pibooth.utils import LOGGER, PoolingTimer, timeit, monotonic
+
+
+if gp:
+    # Errors returned by libgphoto2 when the camera is not reachable anymore
+    GP_DISCONNECTED_ERRORS = tuple(getattr(gp, name) for name in ('GP_ERROR_IO', 'GP_ERROR_IO_USB_FIND',
+                                                                  'GP_ERROR_IO_USB_CLAIM', 'GP_ERROR_MODEL_NOT_FOUND')
+                                   if hasattr(gp, name))
+else:
+    GP_DISCONNECTED_ERRORS = ()
 
 
 def rpi_camera_connected():
@@ -70,19 +82,223 @@ def gp_set_config_value(config, section, option, value):
         raise ValueError('Unsupported setting {}/{}={}'.format(section, option, value))
 
 
+class GpConnection(object):
+
+    """Session with a gPhoto2 camera kept open for the application lifetime.
+    The configuration is sent to the camera only when a value has changed,
+    the connection is restored (with a growing delay between attempts) if
+    the camera is disconnected.
+
+    All accesses to the camera are serialized, thus the connection can be
+    shared between threads.
+    """
+
+    def __init__(self, retries=5, backoff=0.5):
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.RLock()
+        self._camera = None
+        self._config = odict()  # Values required by the application
+        self._applied = {}  # Values sent to the camera
+
+    def _connect(self):
+        """Open the session, retry with a growing delay in case of failure.
+        """
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                camera = gp.Camera()
+                camera.init()
+                LOGGER.debug("gPhoto2 camera connected (attempt %s)", attempt)
+                self._camera = camera
+                self._applied = {}
+                return
+            except gp.GPhoto2Error as ex:
+                if attempt == self.retries:
+                    raise
+                LOGGER.warning("gPhoto2 camera connection failed (%s), retry in %ss", ex, delay)
+                time.sleep(delay)
+                delay *= 2
+
+    def _apply_config(self):
+        """Send the modified configuration values to the camera.
+        """
+        changes = [(key, value) for key, value in self._config.items() if self._applied.get(key) != value]
+        if not changes:
+            return
+        config = self._camera.get_config()
+        for (section, option), value in changes:
+            gp_set_config_value(config, section, option, value)
+        self._camera.set_config(config)
+        self._applied.update(changes)
+
+    def _disconnect(self):
+        """Close the session (ignore errors, the camera may be unplugged).
+        """
+        if self._camera:
+            try:
+                self._camera.exit()
+            except gp.GPhoto2Error as ex:
+                LOGGER.debug("gPhoto2 camera exit failed: %s", ex)
+            self._camera = None
+
+    def set_config_value(self, section, option, value):
+        """Set a configuration value, it will be sent to the camera at the
+        next access if it differs from the current one.
+        """
+        with self.lock:
+            self._config[(section, option)] = value
+
+    def run(self, func, *args):
+        """Call the gPhoto2 function ``func(camera, *args)`` and return its
+        result. The camera is reconnected once if the access has failed
+        because of a disconnection.
+        """
+        with self.lock:
+            for attempt in (1, 2):
+                if not self._camera:
+                    self._connect()
+                self._apply_config()
+                try:
+                    return gp.check_result(func(self._camera, *args))
+                except gp.GPhoto2Error as ex:
+                    if attempt == 2 or ex.code not in GP_DISCONNECTED_ERRORS:
+                        raise
+                    LOGGER.warning("gPhoto2 camera disconnected (%s), reconnecting", ex)
+                    self._disconnect()
+
+    def capture(self, timeout=1):
+        """Take a picture and return its path on the camera. The events
+        pending after the capture (file added...) are drained to keep the
+        camera ready for the next one, for `timeout` seconds at most.
+        """
+        with self.lock:
+            gp_path = self.run(gp.gp_camera_capture, gp.GP_CAPTURE_IMAGE)
+            timer = PoolingTimer(timeout)
+            while not timer.is_timeout():
+                event_type, _data = self.run(gp.gp_camera_wait_for_event, 10)
+                if event_type == gp.GP_EVENT_TIMEOUT:
+                    break  # No more event pending
+            return gp_path
+
+    def close(self):
+        """Close the session.
+        """
+        with self.lock:
+            self._disconnect()
+
+
+class GpPreviewThread(threading.Thread):
+
+    """Thread which pulls the preview frames (MJPEG) from a gPhoto2 camera
+    and decodes them at the display size. Only the last frame is kept.
+    """
+
+    def __init__(self, connection, size, flip=False, fps=15):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fps = fps
+
+        self._connection = connection
+        self._size = size
+        self._flip = flip
+        self._frame = None
+        self._frame_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.start()
+
+    def _decode(self, data):
+        """Return a pygame surface of the display size from the JPEG data.
+        """
+        image = pictures.open_image(io.BytesIO(data), self._size, 'outer')
+        image = image.resize(sizing.new_size_keep_aspect_ratio(image.size, self._size, 'outer'))
+        image = image.crop(sizing.new_size_by_croping(image.size, self._size))
+        if self._flip:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return pygame.image.frombuffer(image.tobytes(), image.size, 'RGB')
+
+    def run(self):
+        """Pull the frames at the maximum of `fps` frames per second.
+        """
+        period = 1. / self.fps
+        while not self._stop_event.is_set():
+            start = monotonic()
+            try:
+                camera_file = self._connection.run(gp.gp_camera_capture_preview)
+                frame = self._decode(memoryview(camera_file.get_data_and_size()))
+                with self._frame_lock:
+                    self._frame = frame
+            except gp.GPhoto2Error as ex:
+                LOGGER.warning("Can not get preview frame: %s", ex)
+            if self._stop_event.wait(max(0, period - (monotonic() - start))):
+                return  # Stop requested
+
+    def get_frame(self):
+        """Return the last decoded frame (None if no frame received yet).
+        """
+        with self._frame_lock:
+            return self._frame
+
+    def stop(self):
+        """Stop the thread.
+        """
+        self._stop_event.set()
+        self.join()
+
+
 class BaseCamera(object):
 
-    def __init__(self, resolution):
+    def __init__(self, resolution, save_captures=True, capture_to_ram=False):
         self._cam = None
         self._border = 50
         self._window = None
         self._captures = {}
+        self._overlays = {}
+        self._overlays_size = None
+        self._preview_timer = None  # (end time, countdown alpha)
         self.resolution = resolution
+        self.save_captures = save_captures
+        self.capture_to_ram = capture_to_ram
+        # The captures kept in memory are written to the disk later
+        self._writer = futures.ThreadPoolExecutor(max_workers=1) if capture_to_ram else None
 
     def _post_process_capture(self, capture_path):
-        """Rework and return a capture from file.
+        """Rework and return a capture from file (or from the memory buffer
+        in RAM mode).
+        """
+        stream = self._captures[capture_path]
+        if stream is None:
+            return Image.open(capture_path)
+        if self.save_captures:
+            self._save_capture(capture_path, stream.getvalue())
+        stream.seek(0)
+        return Image.open(stream)
+
+    def _save_capture(self, capture_path, capture):
+        """Save the capture (PIL image or JPEG data) in the given file. In
+        RAM mode, the file is written in background.
         """
-        return Image.open(capture_path)
+        if self._writer:
+            self._writer.submit(self._write_capture, capture_path, capture)
+        else:
+            self._write_capture(capture_path, capture)
+
+    def _write_capture(self, capture_path, capture):
+        """Write the capture in the given file.
+        """
+        try:
+            if isinstance(capture, bytes):
+                with open(capture_path, 'wb') as fp:
+                    fp.write(capture)
+            else:
+                capture.save(capture_path)
+        except (IOError, OSError) as ex:
+            # The session directory may have been removed meanwhile
+            LOGGER.error("Can not save capture '%s': %s", capture_path, ex)
+            if not self._writer:
+                raise
 
     def get_rect(self):
         """Return a Rect object (as defined in pygame) for resizing preview and images
@@ -97,7 +313,7 @@ class BaseCamera(object):
         """Return a PIL image with the given text that can be used
         as an overlay for the camera.
         """
-        font = ImageFont.truetype(fonts.get_filename("Amatic-Bold.ttf"), size[1] * 8 // 10)
+        font = fonts.get_font("Amatic-Bold.ttf", size[1] * 8 // 10)
         image = Image.new('RGBA', size)
         draw = ImageDraw.Draw(image)
         txt_width, txt_height = draw.textsize(text, font=font)
@@ -105,28 +321,79 @@ class BaseCamera(object):
         draw.text(position, text, (255, 255, 255, alpha), font=font)
         return image
 
-    def get_captures(self):
-        """Return all buffered captures as PIL images (buffer dropped after call).
+    def _get_overlay_buffer(self, size, text, alpha):
+        """Return the overlay (raw RGBA data) with the given text. The
+        overlays are rendered only once for a given size.
+        """
+        if self._overlays_size != size:
+            self._overlays = {}
+            self._overlays_size = size
+        if (text, alpha) not in self._overlays:
+            self._overlays[(text, alpha)] = self.get_overlay(size, text, alpha).tobytes()
+        return self._overlays[(text, alpha)]
+
+    def _get_preview_remaining(self):
+        """Return the remaining seconds of the preview timer.
+        """
+        if not self._preview_timer:
+            return 0.0
+        return max(0.0, self._preview_timer[0] - monotonic())
+
+    def start_preview_timer(self, timeout, alpha=None):
+        """Start a timer of `timeout` seconds on the preview without
+        blocking. A countdown is displayed over the preview if `alpha`
+        is given. The preview shall be refreshed using
+        :py:meth:`update_preview` until the timer is over.
+        """
+        timeout = int(timeout)
+        if timeout < 1:
+            raise ValueError("Start time shall be greater than 0")
+        self._preview_timer = (monotonic() + timeout, alpha)
+
+    def update_preview(self):
+        """Refresh the preview and return True if the preview timer is over.
+        """
+        return self._get_preview_remaining() <= 0
+
+    def get_preview_timeout(self):
+        """Return the seconds before the preview needs to be refreshed.
+        """
+        remain = self._get_preview_remaining()
+        if remain > 0 and self._preview_timer[1] is not None:
+            # Time until the next countdown number
+            return remain - math.ceil(remain) + 1
+        return remain
+
+    def get_capture(self, capture_path):
+        """Return the given buffered capture as PIL image (dropped from the
+        buffer after call).
         """
-        images = []
-        for path in sorted(self._captures):
-            images.append(self._post_process_capture(path))
-        self.drop_captures()
-        return images
+        if capture_path not in self._captures:
+            raise ValueError("No capture '{}' in buffer".format(capture_path))
+        image = self._post_process_capture(capture_path)
+        self._captures.pop(capture_path, None)
+        return image
 
     def drop_captures(self):
         """Delete all buffered captures.
         """
         self._captures = {}
 
+    def quit(self):
+        """Wait for the captures to be written.
+        """
+        if self._writer:
+            self._writer.shutdown(wait=True)
+
 
 class RpiCamera(BaseCamera):
 
     """Camera management
     """
 
-    def __init__(self, iso=200, resolution=(1920, 1080), rotation=0, flip=False):
-        BaseCamera.__init__(self, resolution)
+    def __init__(self, iso=200, resolution=(1920, 1080), rotation=0, flip=False, save_captures=True,
+                 capture_to_ram=False):
+        BaseCamera.__init__(self, resolution, save_captures, capture_to_ram)
         self._cam = picamera.PiCamera()
         self._cam.framerate = 15  # Slower is necessary for high-resolution
         self._cam.video_stabilization = True
@@ -135,6 +402,8 @@ class RpiCamera(BaseCamera):
         self._cam.resolution = resolution
         self._cam.iso = iso
         self._cam.rotation = rotation
+        self._overlay = None
+        self._overlay_number = None
 
     def preview(self, window, flip=True):
         """Display a preview on the given Rect (flip if necessary).
@@ -151,49 +420,77 @@ class RpiCamera(BaseCamera):
         self._cam.start_preview(resolution=(rect.width, rect.height), hflip=flip,
                                 fullscreen=False, window=tuple(rect))
 
-    def preview_countdown(self, timeout, alpha=60):
-        """Show a countdown of `timeout` seconds on the preview.
-        Returns when the countdown is finished.
+    def start_preview_timer(self, timeout, alpha=None):
+        """Start a timer of `timeout` seconds on the preview without
+        blocking. A countdown is displayed over the preview if `alpha`
+        is given.
         """
-        timeout = int(timeout)
-        if timeout < 1:
-            raise ValueError("Start time shall be greater than 0")
         if not self._cam.preview:
             raise EnvironmentError("Preview shall be started first")
+        self._remove_overlay()
+        BaseCamera.start_preview_timer(self, timeout, alpha)
+        if alpha is None:
+            return
 
-        # Create an image padded to the required size
+        # Create images padded to the required size, rendered before the
+        # countdown to not delay the ticks
+        timeout = int(timeout)
         rect = self.get_rect()
         size = (((rect.width + 31) // 32) * 32, ((rect.height + 15) // 16) * 16)
+        for number in range(1, timeout + 1):
+            self._get_overlay_buffer(size, str(number), alpha)
 
-        while timeout > 0:
-            image = self.get_overlay(size, str(timeout), alpha)
-            overlay = self._cam.add_overlay(image.tobytes(), image.size, layer=3,
-                                            window=tuple(rect), fullscreen=False)
-            time.sleep(1)
-            timeout -= 1
-            self._cam.remove_overlay(overlay)
+        # Only one overlay layer, updated each second
+        self._overlay = self._cam.add_overlay(self._get_overlay_buffer(size, str(timeout), alpha), size,
+                                              layer=3, window=tuple(rect), fullscreen=False)
+        self._overlay_number = timeout
 
-    def preview_wait(self, timeout):
-        """Wait the given time.
+    def update_preview(self):
+        """Update the countdown and return True if the preview timer is over.
+        """
+        remain = self._get_preview_remaining()
+        if remain <= 0:
+            self._remove_overlay()
+            return True
+        number = int(math.ceil(remain))
+        if self._overlay and number != self._overlay_number:
+            self._overlay.update(self._get_overlay_buffer(self._overlays_size, str(number),
+                                                          self._preview_timer[1]))
+            self._overlay_number = number
+        return False
+
+    def _remove_overlay(self):
+        """Remove the countdown overlay (if any).
         """
-        time.sleep(timeout)
+        if self._overlay:
+            self._cam.remove_overlay(self._overlay)
+            self._overlay = None
+            self._overlay_number = None
 
     def stop_preview(self):
         """Stop the preview.
         """
+        self._remove_overlay()
         self._cam.stop_preview()
+        self._preview_timer = None
         self._window = None
 
     def capture(self, filename):
-        """Capture a picture in a file.
+        """Capture a picture in a file (or in memory in RAM mode).
         """
-        self._cam.capture(filename)
-        self._captures[filename] = None  # Nothing to keep for post processing
+        if self.capture_to_ram:
+            stream = io.BytesIO()
+            self._cam.capture(stream, format='jpeg')
+            self._captures[filename] = stream
+        else:
+            self._cam.capture(filename)
+            self._captures[filename] = None  # Nothing to keep for post processing
 
     def quit(self):
         """Close the camera driver, it's definitive.
         """
         self._cam.close()
+        BaseCamera.quit(self)
 
 
 class GpCamera(BaseCamera):
@@ -201,115 +498,119 @@ class GpCamera(BaseCamera):
     """gPhoto2 camera management.
     """
 
-    def __init__(self, iso=200, resolution=(1920, 1080), rotation=0, flip=False):
-        BaseCamera.__init__(self, resolution)
+    def __init__(self, iso=200, resolution=(1920, 1080), rotation=0, flip=False, save_captures=True,
+                 capture_to_ram=False):
+        BaseCamera.__init__(self, resolution, save_captures, capture_to_ram)
         gp.check_result(gp.use_python_logging())
 
         self._preview_hflip = False
         self._capture_hflip = flip
         self._rotation = rotation
-        self._iso = str(iso)
-        self.gphoto2_process = None
-        self.omxplayer_process = None
+        self._preview_thread = None
 
-    def _init(self):
-        """Camera initialisation
-        """
-        self._cam = gp.Camera()
-        self._cam.init()
-        config = self._cam.get_config()
-        gp_set_config_value(config, 'imgsettings', 'iso', self._iso)
-        gp_set_config_value(config, 'settings', 'capturetarget', 'Carte mémoire')
-        self._cam.set_config(config)
+        # Captures may be post-processed in another thread while the next
+        # one is taken: the connection serializes the access to the camera
+        self._cam = GpConnection()
+        self._cam.set_config_value('imgsettings', 'iso', str(iso))
+        self._cam.set_config_value('settings', 'capturetarget', 'Carte mémoire')
 
     def _post_process_capture(self, capture_path):
         gp_path = self._captures[capture_path]
-        camera_file = gp.check_result(gp.gp_camera_file_get(
-            self._cam, gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL))
+        camera_file = self._cam.run(gp.gp_camera_file_get, gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL)
 
-        image = Image.open(io.BytesIO(memoryview(camera_file.get_data_and_size())))
+        image = pictures.open_image(io.BytesIO(memoryview(camera_file.get_data_and_size())),
+                                    self.resolution, 'outer')
         image = image.resize(sizing.new_size_keep_aspect_ratio(image.size, self.resolution, 'outer'), Image.ANTIALIAS)
         image = image.crop(sizing.new_size_by_croping(image.size, self.resolution))
 
         if self._capture_hflip:
             image = image.transpose(Image.FLIP_LEFT_RIGHT)
-        image.save(capture_path)
+        if self.save_captures:
+            self._save_capture(capture_path, image)
         return image
 
-    def preview(self, window, flip=True, timeout=5):
-        """Setup the preview.
+    def _get_preview_rect(self):
+        """Return the preview Rect relatively to the window surface.
         """
-        if not self.gphoto2_process:
-            self._window = window
-            rect = self.get_rect()
-            if flip:
-                orientation = 1
-            else:
-                orientation = 0
-            self.gphoto2_process = subprocess.Popen("gphoto2 --capture-movie --stdout> fifo.mjpg &",
-                                                    shell=True,
-                                                    preexec_fn=os.setsid)
-            window_rect = '{0},{1},{2},{3}'.format(tuple(rect)[0], tuple(rect)[1], tuple(rect)[
-                                                   0] + tuple(rect)[2], tuple(rect)[1] + tuple(rect)[3])
-            command = "omxplayer fifo.mjpg --live --crop 252,0,804,704 --win {0} --orientation {1}".format(
-                window_rect, orientation)
-            self.omxplayer_process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
-
-    def preview_countdown(self, timeout, alpha=60):
-        """Show a countdown of `timeout` seconds on the preview.
-        Returns when the countdown is finished.
+        rect = self.get_rect()
+        rect.center = self._window.surface.get_rect().center
+        return rect
+
+    def _show_preview_frame(self, overlay=None):
+        """Blit the last preview frame (and the overlay if given) on the
+        window.
         """
-        timeout = int(timeout)
-        if timeout < 1:
-            raise ValueError("Start time shall be greater than 0")
+        frame = self._preview_thread.get_frame()
+        if frame is None:
+            return  # No frame received yet
+        rect = self._get_preview_rect()
+        self._window.surface.blit(frame, rect)
+        if overlay:
+            self._window.surface.blit(overlay, rect)
+        pygame.display.update(rect)
 
-        overlay = None
-        timer = PoolingTimer(timeout)
-        while not timer.is_timeout():
-            self.preview(self._window)
-            remaining = int(timer.remaining() + 1)
-            if not overlay or remaining != timeout:
-                # Rebluid overlay only if remaining number has changed
-                # overlay = self.get_overlay(image.size, str(remaining), alpha)
-                timeout = remaining
-            #image.paste(overlay, (0, 0), overlay)
-            # self._window.show_image(image)
-
-    def preview_wait(self, timeout):
-        """Wait the given time and refresh the preview.
+    def preview(self, window, flip=True):
+        """Start the preview thread which pulls and decodes the frames.
         """
-        timeout = int(timeout)
-        if timeout < 1:
-            raise ValueError("Start time shall be greater than 0")
+        if self._preview_thread:
+            return  # Preview already running
+        self._window = window
+        self._preview_hflip = flip
+        self._preview_thread = GpPreviewThread(self._cam, self._get_preview_rect().size, flip)
 
-        timer = PoolingTimer(timeout)
-        while not timer.is_timeout():
-            self.preview(self._window, timeout=timeout)
+    def start_preview_timer(self, timeout, alpha=None):
+        """Start a timer of `timeout` seconds on the preview without
+        blocking. A countdown is displayed over the preview if `alpha`
+        is given.
+        """
+        if not self._preview_thread:
+            raise EnvironmentError("Preview shall be started first")
+        BaseCamera.start_preview_timer(self, timeout, alpha)
+
+    def update_preview(self):
+        """Display the last preview frame (with the countdown if any) and
+        return True if the preview timer is over.
+        """
+        remain = self._get_preview_remaining()
+        overlay = None
+        alpha = self._preview_timer[1] if self._preview_timer else None
+        if remain > 0 and alpha is not None:
+            rect = self._get_preview_rect()
+            overlay = pygame.image.frombuffer(self._get_overlay_buffer(rect.size, str(int(math.ceil(remain))), alpha),
+                                              rect.size, 'RGBA')
+        if self._preview_thread:
+            self._show_preview_frame(overlay)
+        return remain <= 0
+
+    def get_preview_timeout(self):
+        """Return the seconds before the preview needs to be refreshed.
+        """
+        timeout = BaseCamera.get_preview_timeout(self)
+        if self._preview_thread:
+            return min(timeout, 1. / self._preview_thread.fps)
+        return timeout
 
     def stop_preview(self):
         """Stop the preview.
         """
-        if self.gphoto2_process:
-            os.killpg(os.getpgid(self.gphoto2_process.pid), signal.SIGTERM)
-            self.gphoto2_process = None
-        if self.omxplayer_process:
-            os.killpg(os.getpgid(self.omxplayer_process.pid), signal.SIGTERM)
-            self.omxplayer_process = None
+        if self._preview_thread:
+            self._preview_thread.stop()
+            self._preview_thread = None
+            self._window.update()  # Remove the last frame painted on the window
+        self._preview_timer = None
         self._window = None
 
     def capture(self, filename):
         """Capture a picture in a file.
         """
-        self._init()
-        self._captures[filename] = self._cam.capture(gp.GP_CAPTURE_IMAGE)
-        time.sleep(1)  # Necessary to let the time for the camera to save the image
-        self.quit()
+        self._captures[filename] = self._cam.capture()
 
     def quit(self):
         """Close the camera driver, it's definitive.
         """
-        if self._cam:
-            self._cam.exit()
+        self.stop_preview()
+        self._cam.close()
+        BaseCamera.quit(self)
 
 
 class HybridCamera(RpiCamera):
@@ -322,38 +623,34 @@ class HybridCamera(RpiCamera):
     def __init__(self, *args, **kwargs):
         RpiCamera.__init__(self, *args, **kwargs)
         gp.check_result(gp.use_python_logging())
-        self._gp_cam = gp.Camera()
-        self._gp_cam.init()
-
-        config = self._gp_cam.get_config()
-        gp_set_config_value(config, 'imgsettings', 'iso', self._cam.iso)
-        gp_set_config_value(config, 'settings', 'capturetarget', 'Carte mémoire')
-        self._gp_cam.set_config(config)
+        self._gp_cam = GpConnection()
+        self._gp_cam.set_config_value('imgsettings', 'iso', str(self._cam.iso))
+        self._gp_cam.set_config_value('settings', 'capturetarget', 'Carte mémoire')
 
     def _post_process_capture(self, capture_path):
         gp_path = self._captures[capture_path]
-        camera_file = gp.check_result(gp.gp_camera_file_get(
-            self._gp_cam, gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL))
+        camera_file = self._gp_cam.run(gp.gp_camera_file_get, gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL)
 
-        image = Image.open(io.BytesIO(memoryview(camera_file.get_data_and_size())))
+        image = pictures.open_image(io.BytesIO(memoryview(camera_file.get_data_and_size())),
+                                    self._cam.resolution, 'outer')
         image = image.resize(sizing.new_size_keep_aspect_ratio(
             image.size, self._cam.resolution, 'outer'), Image.ANTIALIAS)
         image = image.crop(sizing.new_size_by_croping(image.size, self._cam.resolution))
 
         if self._cam.hflip:
             image = image.transpose(Image.FLIP_LEFT_RIGHT)
-        image.save(capture_path)
+        if self.save_captures:
+            self._save_capture(capture_path, image)
         return image
 
     def capture(self, filename):
         """Capture a picture in a file.
         """
-        RpiCamera.capture(self, filename)  # Just to show a captured image at screen
-        self._captures[filename] = self._gp_cam.capture(gp.GP_CAPTURE_IMAGE)
-        time.sleep(1)  # Necessary to let the time for the camera to save the image
+        RpiCamera.capture(self, filename)  # Just to show a captured image at screen (in memory in RAM mode)
+        self._captures[filename] = self._gp_cam.capture()
 
     def quit(self):
         """Close the camera driver, it's definitive.
         """
         RpiCamera.quit(self)
-        self._gp_cam.exit()
+        self._gp_cam.close()
@@ -4,24 +4,35 @@ try:
     import cups
 except ImportError:
     cups = None  # CUPS is optional
+import os
+import time
 import tempfile
+import functools
 import threading
 import collections
 import os.path as osp
-from PIL import Image
+from collections import OrderedDict as odict
+from concurrent import futures
 from xml.etree import ElementTree
 try:
+    from socketserver import ThreadingMixIn
     from http.server import HTTPServer, BaseHTTPRequestHandler
 except ImportError:
     # Python 2.x fallback
+    from SocketServer import ThreadingMixIn
     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from pibooth.utils import LOGGER
-from pibooth.pictures.concatenate import concatenate_pictures
+from pibooth import pictures
+from pibooth.pictures.concatenate import IncrementalCompositor
 
 
-class NotificationHandler(BaseHTTPRequestHandler):
+# Jobs states defined by IPP (RFC 8011)
+JOB_STATES = {3: 'pending', 4: 'held', 5: 'processing', 6: 'stopped',
+              7: 'canceled', 8: 'aborted', 9: 'completed'}
+ACTIVE_JOB_STATES = ('pending', 'held', 'processing', 'stopped')
+
 
-    _last_notif = collections.deque(maxlen=500)
+class NotificationHandler(BaseHTTPRequestHandler):
 
     def get_chunk_size(self):
         size_str = self.rfile.read(2)
@@ -59,22 +70,29 @@ class NotificationHandler(BaseHTTPRequestHandler):
             root = ElementTree.fromstring(chunk_data.decode('utf-8'))
             for channel in root.iterfind('channel'):
                 for item in reversed([e for e in channel.iterfind('item')]):
-                    txt = ElementTree.tostring(item, encoding='utf8')
-                    if txt not in NotificationHandler._last_notif:
-                        # Print only the new notifications
-                        LOGGER.info("%s - %s", item.findtext('pubDate'), item.findtext('title'))
-                        NotificationHandler._last_notif.append(txt)
+                    self.server.add_notification(item)
 
         self.send_response(200)
         self.end_headers()
 
 
-class NotificationServer(HTTPServer):
+class NotificationServer(ThreadingMixIn, HTTPServer):
+
+    """Receive the notifications of the CUPS server, each request is handled
+    in its own thread.
+    """
 
-    def __init__(self, cups_conn):
+    daemon_threads = True
+    max_notifications = 500  # Number of notifications IDs kept to ignore duplicates
+
+    def __init__(self, cups_conn, callback=None):
         HTTPServer.__init__(self, ('localhost', 9988), NotificationHandler)
         self._thread = None
         self._conn = cups_conn
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._notifs = set()
+        self._notifs_order = collections.deque()
         self.notif_uri = 'rss://{}:{}'.format(self.server_address[0],
                                               self.server_address[1])
 
@@ -99,6 +117,23 @@ class NotificationServer(HTTPServer):
                                               'printer-shutdown',
                                               'printer-stopped'])
 
+    def add_notification(self, item):
+        """Handle a notification (RSS item), the ones already received are
+        ignored (CUPS sends all the recent ones at each request).
+        """
+        key = item.findtext('guid') or ElementTree.tostring(item, encoding='utf8')
+        with self._lock:
+            if key in self._notifs:
+                return
+            self._notifs.add(key)
+            self._notifs_order.append(key)
+            if len(self._notifs_order) > self.max_notifications:
+                self._notifs.discard(self._notifs_order.popleft())
+
+        LOGGER.info("%s - %s", item.findtext('pubDate'), item.findtext('title'))
+        if self._callback:
+            self._callback()
+
     def is_running(self):
         """Return True if the notification server is started.
         """
@@ -128,9 +163,25 @@ class NotificationServer(HTTPServer):
 
 class PtbPrinter(object):
 
-    def __init__(self, name='default'):
+    """Printer management. The sheets rendering, the submissions to CUPS and
+    the jobs states updates are queued and executed one after the other in
+    a dedicated thread (the CUPS connection is not shared between threads).
+    """
+
+    MAX_SHEETS = 2  # Number of pre-rendered sheets kept on disk
+    MAX_JOBS = 100  # Number of submitted jobs IDs kept
+
+    def __init__(self, name='default', page_time=60):
         self._conn = cups.Connection() if cups else None
-        self._notif_server = NotificationServer(self._conn)
+        self._notif_server = NotificationServer(self._conn, self.refresh)
+        self._executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._sheets = odict()  # (filename, copies): path of the file to print
+        self._jobs = odict()  # CUPS job ID: (filename, state)
+        self._jobs_lock = threading.Lock()
+        self._jobs_started = {}  # CUPS job ID: time when processing started
+        self._refresh_queued = False
+        self._callbacks = []
+        self.page_time = float(page_time)  # Estimated time to print a page, updated with measured ones
         self.name = None
         if not cups:
             LOGGER.warning("No printer found (pycups not installed)")
@@ -150,21 +201,145 @@ class PtbPrinter(object):
         """
         return cups is not None and self.name
 
-    def print_file(self, filename, copies=1):
-        """Send a file to the CUPS server to the default printer.
+    def _get_sheet(self, filename, copies, picture=None):
+        """Return the path to the file to print for the given number of
+        copies per page. The sheet is rendered and saved in a temporary
+        file only once.
+        """
+        if copies <= 1:
+            return filename
+        key = (filename, copies)
+        if key not in self._sheets:
+            compositor = IncrementalCompositor(copies, orientation='revauto', inter_width=2)
+            if picture is None:
+                picture = pictures.open_image(filename)
+                # Decode the picture at the size of the copies only
+                pictures.draft_image(picture, compositor.get_slot_size(picture.size))
+            for _ in range(copies):
+                compositor.add_picture(picture)
+            fd, path = tempfile.mkstemp(suffix=osp.basename(filename))
+            os.close(fd)
+            compositor.build().save(path, 'JPEG')
+            self._sheets[key] = path
+            while len(self._sheets) > self.MAX_SHEETS:
+                os.remove(self._sheets.popitem(last=False)[1])
+        return self._sheets[key]
+
+    def _print(self, filename, copies):
+        """Send the sheet to the CUPS server and return the job ID.
+        """
+        try:
+            return self._send(filename, copies)
+        except Exception as ex:
+            # Logged because the job may be never consulted
+            LOGGER.error("Failed to print '%s': %s", filename, ex)
+            raise
+
+    def _send(self, filename, copies):
+        """Send the sheet to the CUPS server and return the job ID.
         """
         if not self._notif_server.is_running():
             self._notif_server.start()
         if not self.name:
             raise EnvironmentError("No printer found (check config file or CUPS config)")
 
-        if copies > 1:
-            with tempfile.NamedTemporaryFile(suffix=osp.basename(filename)) as fp:
-                picture = Image.open(filename)
-                concatenate_pictures((picture,) * copies, orientation='revauto', inter_width=2).save(fp.name)
-                self._conn.printFile(self.name, fp.name, osp.basename(filename), {})
-        else:
-            self._conn.printFile(self.name, filename, osp.basename(filename), {})
+        job_id = self._conn.printFile(self.name, self._get_sheet(filename, copies), osp.basename(filename), {})
+        with self._jobs_lock:
+            self._jobs[job_id] = (filename, 'pending')
+            while len(self._jobs) > self.MAX_JOBS:
+                self._jobs.popitem(last=False)
+        LOGGER.info("Print job %s created for '%s'", job_id, filename)
+        return job_id
+
+    def _refresh_jobs(self):
+        """Update the state of the unfinished jobs.
+        """
+        self._refresh_queued = False
+        with self._jobs_lock:
+            unfinished = [job_id for job_id, job in self._jobs.items() if job[1] in ACTIVE_JOB_STATES]
+        for job_id in unfinished:
+            try:
+                state = JOB_STATES.get(self._conn.getJobAttributes(job_id).get('job-state'), 'unknown')
+            except cups.IPPError as ex:
+                LOGGER.warning("Can not get state of print job %s: %s", job_id, ex)
+                state = 'unknown'  # Purged by CUPS
+            with self._jobs_lock:
+                filename, previous = self._jobs.get(job_id, (None, None))
+                if not filename or state == previous:
+                    continue
+                self._jobs[job_id] = (filename, state)
+            LOGGER.info("Print job %s is %s", job_id, state)
+            self._update_page_time(job_id, state)
+            for callback in self._callbacks:
+                callback()
+
+    def _update_page_time(self, job_id, state):
+        """Measure the printing time of the job to update the estimated time
+        to print a page (moving average).
+        """
+        if state == 'processing':
+            self._jobs_started[job_id] = time.time()
+        elif state not in ACTIVE_JOB_STATES:
+            start = self._jobs_started.pop(job_id, None)
+            if start is not None and state == 'completed':
+                self.page_time = 0.7 * self.page_time + 0.3 * (time.time() - start)
+
+    def add_callback(self, callback):
+        """Add a function called (from the printer thread, without argument)
+        when the state of a job changes.
+        """
+        self._callbacks.append(callback)
+
+    def refresh(self):
+        """Queue an update of the jobs states (called for each CUPS
+        notification, can be called from any thread).
+        """
+        if self.is_installed() and not self._refresh_queued:
+            self._refresh_queued = True
+            try:
+                self._executor.submit(self._refresh_jobs)
+            except RuntimeError:
+                pass  # Printer is stopping
+
+    def get_job_state(self, job_id):
+        """Return the state of the given job ('pending', 'held', 'processing',
+        'stopped', 'canceled', 'aborted', 'completed' or 'unknown'), None if
+        the job has not been sent by this printer.
+        """
+        with self._jobs_lock:
+            return self._jobs.get(job_id, (None, None))[1]
+
+    def is_job_finished(self, job_id):
+        """Return True if the given job is finished (or unknown).
+        """
+        return self.get_job_state(job_id) not in ACTIVE_JOB_STATES
+
+    def get_queue_depth(self):
+        """Return the number of unfinished jobs sent by this printer.
+        """
+        with self._jobs_lock:
+            return len([job for job in self._jobs.values() if job[1] in ACTIVE_JOB_STATES])
+
+    def prepare(self, filename, picture=None, copies=1):
+        """Render in background the sheet to print for the given file, before
+        any print request. The in-memory picture is used if given (to not
+        decode the file again). Return a future.
+        """
+        if not self.is_installed() or copies <= 1:
+            return None
+        return self._executor.submit(self._get_sheet, filename, copies, picture)
+
+    def submit(self, filename, copies=1):
+        """Queue the given file to be printed with `copies` pictures per
+        page. Return a future giving the CUPS job ID.
+        """
+        return self._executor.submit(self._print, filename, copies)
+
+    def print_file(self, filename, copies=1):
+        """Send a file to the CUPS server to the default printer. Return
+        the CUPS job ID.
+        """
+        return self.submit(filename, copies).result()
 
     def cancel_all_tasks(self):
         """Cancel all tasks in the queue.
@@ -176,4 +351,83 @@ class PtbPrinter(object):
     def quit(self):
         """Do cleanup actions.
         """
+        self._executor.shutdown(wait=True)
         self._notif_server.shutdown()
+        for path in self._sheets.values():
+            os.remove(path)
+        self._sheets.clear()
+
+
+class PrintScheduler(object):
+
+    """Print requests scheduler in front of the printer. Only `max_jobs`
+    jobs are sent to CUPS at the same time, the other requests wait in the
+    scheduler queue where the requests of a same picture are batched on a
+    multi-up sheet. A request is rejected if the estimated waiting time
+    exceeds `max_wait` seconds.
+    """
+
+    MAX_COPIES = 4  # Maximum number of pictures per page
+
+    def __init__(self, printer, max_jobs=2, max_wait=300):
+        self.printer = printer
+        self.max_jobs = max_jobs
+        self.max_wait = max_wait
+        self._queue = []  # Waiting requests: [filename, copies, future]
+        self._sending = 0  # Number of requests sent to the printer without job ID yet
+        self._lock = threading.RLock()
+        self.printer.add_callback(self.process)
+
+    def _on_sent(self, future, job):
+        """Forward the result of the printer submission to the request.
+        """
+        with self._lock:
+            self._sending -= 1
+        if job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            future.set_result(job.result())
+
+    def get_queue_depth(self):
+        """Return the number of pages waiting to be printed (in CUPS and in
+        the scheduler).
+        """
+        with self._lock:
+            return self.printer.get_queue_depth() + self._sending + len(self._queue)
+
+    def get_wait_time(self):
+        """Return the estimated time in seconds before a new page is printed.
+        """
+        return self.get_queue_depth() * self.printer.page_time
+
+    def request(self, filename, copies=1):
+        """Request to print the file with `copies` pictures per page. Return
+        a future giving the CUPS job ID, None if the request is rejected.
+        """
+        with self._lock:
+            for waiting in self._queue:
+                if waiting[0] == filename and waiting[1] + copies <= self.MAX_COPIES:
+                    waiting[1] += copies
+                    LOGGER.info("Print of '%s' batched with a waiting one (%s pictures per page)",
+                                filename, waiting[1])
+                    return waiting[2]
+
+            if self.get_wait_time() > self.max_wait:
+                LOGGER.warning("Print of '%s' rejected, %s pages in the queue (about %ss)",
+                               filename, self.get_queue_depth(), int(self.get_wait_time()))
+                return None
+
+            future = futures.Future()
+            self._queue.append([filename, copies, future])
+        self.process()
+        return future
+
+    def process(self):
+        """Send the waiting requests to the printer while the maximum number
+        of jobs is not reached (can be called from any thread).
+        """
+        with self._lock:
+            while self._queue and self.printer.get_queue_depth() + self._sending < self.max_jobs:
+                filename, copies, future = self._queue.pop(0)
+                self._sending += 1
+                self.printer.submit(filename, copies).add_done_callback(functools.partial(self._on_sent, future))
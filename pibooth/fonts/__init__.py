@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import threading
 import os.path as osp
+from collections import OrderedDict as odict
+from PIL import ImageFont
+
+
+# Fonts objects are shared between the camera overlays (main thread) and
+# the final picture rendering (pictures pool)
+_FONTS = odict()
+_FONTS_MAX = 16
+_FONTS_LOCK = threading.Lock()
+_FONTS_STATS = {'hits': 0, 'misses': 0}
 
 
 def get_filename(name):
@@ -8,3 +19,29 @@ def get_filename(name):
     package.
     """
     return osp.join(osp.dirname(osp.abspath(__file__)), name)
+
+
+def get_font(name, size):
+    """Return a PIL font object for the given font file name and size. The
+    fonts are loaded only once, the least recently used ones are dropped
+    when the maximum number of loaded fonts is reached.
+    """
+    key = (name, int(size))
+    with _FONTS_LOCK:
+        if key in _FONTS:
+            _FONTS_STATS['hits'] += 1
+            _FONTS[key] = _FONTS.pop(key)  # Most recently used at the end
+        else:
+            _FONTS_STATS['misses'] += 1
+            _FONTS[key] = ImageFont.truetype(get_filename(name), key[1])
+            while len(_FONTS) > _FONTS_MAX:
+                _FONTS.popitem(last=False)
+        return _FONTS[key]
+
+
+def get_cache_info():
+    """Return a dictionary with the number of hits and misses of the fonts
+    cache and its current and maximum sizes.
+    """
+    with _FONTS_LOCK:
+        return dict(_FONTS_STATS, size=len(_FONTS), maxsize=_FONTS_MAX)
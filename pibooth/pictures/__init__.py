@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import threading
 import os.path as osp
 from PIL import Image
 import pygame
 from pibooth.config import PiConfigParser
+from pibooth.utils import LOGGER
 from pibooth.pictures import sizing
+from pibooth.pictures.surfaces import to_surface
+
+
+# Resized images (PIL) and their surfaces, by (language, name, size, antialiasing),
+# only the ones for the current window size are kept
+_RESIZED_IMAGES = {}
+_SURFACES = {}
+_IMAGES_LOCK = threading.Lock()
+_PRELOAD_SIZE = None
+_PRELOAD_THREAD = None
 
 
 def get_filename(name):
@@ -13,16 +27,113 @@ def get_filename(name):
     return osp.join(osp.dirname(osp.abspath(__file__)), PiConfigParser.language, name)
 
 
+def draft_image(image, size, resize_type='inner'):
+    """Configure the given PIL image (opened but not loaded yet) to be decoded
+    at the lowest resolution still greater than the size it will be resized
+    to. Only JPEG images support this mode (scaling done at decoding by the
+    DCT, by a factor 1/2, 1/4 or 1/8), other images are unchanged.
+
+    :param size: size the image will be resized to
+    :param resize_type: 'inner' or 'outer' resize (see :py:func:`sizing.new_size_keep_aspect_ratio`)
+    """
+    if image.format == 'JPEG':
+        target = sizing.new_size_keep_aspect_ratio(image.size, size, resize_type)
+        if target[0] <= image.size[0] // 2 and target[1] <= image.size[1] // 2:
+            image.draft(image.mode, target)
+    return image
+
+
+def open_image(source, size=None, resize_type='inner'):
+    """Open an image file (path or file object). If a size is given, the
+    image is decoded at the lowest resolution needed to be resized to this
+    size (see :py:func:`draft_image`).
+    """
+    image = Image.open(source)
+    if size:
+        draft_image(image, size, resize_type)
+    return image
+
+
+def _get_resized_image(name, size, antialiasing=True, window_size=None):
+    """Return a PIL image resized keeping the original image's aspect ratio.
+    If the window size is given, the image is kept in cache only if the
+    pictures are still preloaded for this window size.
+    """
+    key = (PiConfigParser.language, name, size, antialiasing)
+    with _IMAGES_LOCK:
+        image = _RESIZED_IMAGES.get(key)
+    if image is None:
+        image = Image.open(get_filename(name))
+        image = image.resize(sizing.new_size_keep_aspect_ratio(image.size, size),
+                             Image.ANTIALIAS if antialiasing else Image.NEAREST)
+        with _IMAGES_LOCK:
+            if window_size is None or window_size == _PRELOAD_SIZE:
+                image = _RESIZED_IMAGES.setdefault(key, image)
+    return image
+
+
+def get_resized_image(name, size, antialiasing=True):
+    """Return a PIL image resized keeping the original image's aspect ratio.
+    The image is decoded and resized only once for a given size.
+
+    :param antialiasing: use antialiasing algorithm when resize
+    """
+    return _get_resized_image(name, size, antialiasing)
+
+
 def get_image(name, size=None, antialiasing=True):
     """Return a Pygame image. If a size is given, the image is
     resized keeping the original image's aspect ratio.
 
+    The surfaces are created only once for a given size (see
+    :py:func:`preload_images`).
+
     :param antialiasing: use antialiasing algorithm when resize
     """
     if not size:
         return pygame.image.load(get_filename(name)).convert()
     else:
-        image = Image.open(get_filename(name))
-        image = image.resize(sizing.new_size_keep_aspect_ratio(image.size, size),
-                             Image.ANTIALIAS if antialiasing else Image.NEAREST)
-        return pygame.image.fromstring(image.tobytes(), image.size, image.mode)
+        key = (PiConfigParser.language, name, size, antialiasing)
+        if key not in _SURFACES:
+            _SURFACES[key] = to_surface(get_resized_image(name, size, antialiasing))
+        return _SURFACES[key]
+
+
+def _preload_images(size):
+    """Decode and resize all pictures of the current language to be displayed
+    in a window of the given size (layouts are sized as in the choice views).
+    """
+    start = time.time()
+    path = osp.dirname(get_filename('any'))
+    names = sorted(name for name in os.listdir(path) if name.endswith('.png'))
+    for name in names:
+        if name.startswith('layout'):
+            continue
+        if _PRELOAD_SIZE != size:
+            return  # Window resized meanwhile
+        image = _get_resized_image(name, size, window_size=size)
+        if name in ('choose.png', 'chosen.png'):
+            layout_size = (image.size[0] * 0.6, image.size[1] * 0.6)
+            for layout_name in names:
+                if layout_name.startswith('layout'):
+                    _get_resized_image(layout_name, layout_size, window_size=size)
+    LOGGER.debug("Pictures preloaded for window size %s (took %0.3f seconds)", size, time.time() - start)
+
+
+def preload_images(size):
+    """Start a background thread which prepares the pictures for a window of
+    the given size, thus displaying a view requires only a blit. The
+    pictures prepared for the previous size are dropped.
+    """
+    global _PRELOAD_SIZE, _PRELOAD_THREAD
+    size = tuple(size)
+    with _IMAGES_LOCK:
+        if size == _PRELOAD_SIZE:
+            return _PRELOAD_THREAD  # Running or done for this size
+        _PRELOAD_SIZE = size
+        _RESIZED_IMAGES.clear()
+        _SURFACES.clear()
+        _PRELOAD_THREAD = threading.Thread(target=_preload_images, args=(size,))
+        _PRELOAD_THREAD.daemon = True
+        _PRELOAD_THREAD.start()
+        return _PRELOAD_THREAD
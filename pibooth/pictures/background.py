@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import pygame
+from pibooth import fonts
 from pibooth import pictures
+from pibooth.config import PiConfigParser
 
 
 class Background(object):
@@ -123,6 +126,50 @@ class PrintBackground(Background):
         Background.__init__(self, "print.png")
 
 
+class PrintingBackground(Background):
+
+    """Background showing the number of print jobs in the queue on the
+    right side of the screen (the picture is displayed on the left).
+    """
+
+    texts = {'en': (u"Printing...", u"{} in the queue"),
+             'fr': (u"Impression...", u"{} en attente"),
+             'de': (u"Drucken...", u"{} in der Warteschlange")}
+
+    busy_texts = {'en': (u"Printer is busy", u"{} in the queue, try later"),
+                  'fr': (u"Imprimante occupée", u"{} en attente, réessayez plus tard"),
+                  'de': (u"Drucker ist beschäftigt", u"{} in der Warteschlange, später versuchen")}
+
+    def __init__(self, queue_depth, busy=False):
+        Background.__init__(self, "printing")
+        self.queue_depth = queue_depth
+        self.busy = busy
+        self.texts_surfaces = []
+
+    def __str__(self):
+        return "{}{}".format("busy" if self.busy else "printing", self.queue_depth)
+
+    def resize(self, screen):
+        if self.rect != screen.get_rect():
+            self.rect = screen.get_rect()
+            texts = self.busy_texts if self.busy else self.texts
+            title, detail = texts.get(PiConfigParser.language, texts['en'])
+            self.texts_surfaces = []
+            for text, size in ((title, self.rect.height // 6), (detail.format(self.queue_depth), self.rect.height // 10)):
+                font = pygame.font.Font(fonts.get_filename("Amatic-Bold.ttf"), size)
+                self.texts_surfaces.append(font.render(text, True, (255, 255, 255)))
+            return True
+        return False
+
+    def paint(self, screen):
+        screen.fill((0, 0, 0))  # Clear background
+        x = self.rect.centerx + self.rect.centerx // 2
+        y = self.rect.centery - sum(surface.get_height() for surface in self.texts_surfaces) // 2
+        for surface in self.texts_surfaces:
+            screen.blit(surface, surface.get_rect(midtop=(x, y)))
+            y += surface.get_height()
+
+
 class FinishedBackground(Background):
 
     def __init__(self):
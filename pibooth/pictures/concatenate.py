@@ -1,228 +1,213 @@
 # -*- coding: utf-8 -*-
 
-from PIL import Image, ImageDraw, ImageFont
+import threading
+import os.path as osp
+from collections import OrderedDict as odict
+from PIL import Image, ImageDraw
 from pibooth import fonts
-from pibooth.pictures import sizing
+from pibooth.utils import LOGGER
+from pibooth.pictures import sizing, layout
+
+
+# Keep only the last rendered base images (the configuration rarely changes),
+# one per orientation at most: each one is a full size RGB image (~26 MB)
+_BASE_IMAGES = odict()
+_BASE_IMAGES_MAX = 2
+_BASE_IMAGES_LOCK = threading.Lock()
 
 
 def new_image_with_background(width, height, background):
     """Create a new image with the given background. The background can be
-    a RGB color tuple ora PIL image.
+    a RGB color tuple, a PIL image or a path to an image file.
     """
     if isinstance(background, (tuple, list)):
         return Image.new('RGB', (width, height), color=background)
     else:
+        if not isinstance(background, Image.Image):
+            background = Image.open(background)
         image = Image.new('RGB', (width, height))
         image.paste(background.resize(sizing.new_size_keep_aspect_ratio(background.size, image.size, 'outer')))
         return image
 
 
-def concatenate_pictures_portrait(pictures, footer_texts, bg_color, text_color, inter_width=None):
-    """
-    Merge up to 4 PIL images in portrait orientation.
-
-      +---------+     +---------+     +---+-+---+     +---------+
-      |         |     |   +-+   |     |   |1|   |     | +-+ +-+ |
-      |         |     |   |1|   |     |   +-+   |     | |1| |2| |
-      |   +-+   |     |   +-+   |     |   +-+   |     | +-+ +-+ |
-      |   |1|   |     |         |     |   |2|   |     |         |
-      |   +-+   |     |   +-+   |     |   +-+   |     | +-+ +-+ |
-      |         |     |   |2|   |     |   +-+   |     | |3| |4| |
-      |         |     |   +-+   |     |   |3|   |     | +-+ +-+ |
-      +---------+     +---------+     +---+-+---+     +---------+
+def draw_footer(image, texts_boxes, footer_texts, text_color):
+    """Draw the footer texts in the boxes defined by the layout template.
     """
-    widths, heights = zip(*(i.size for i in pictures))
-
-    # starting here we consider that all the images have the same height and widths
-    if inter_width is None:
-        inter_width = max(heights) // 20
-
-    if len(pictures) == 1:
-        new_width = max(widths) + inter_width * 2
-        new_height = max(heights) + inter_width * 2
-    elif len(pictures) == 2:
-        new_width = max(widths) + inter_width * 2
-        new_height = max(heights) * 2 + inter_width * 3
-    elif len(pictures) == 3:
-        new_width = max(widths) + inter_width * 2
-        new_height = max(heights) * 3 + inter_width * 4
-    elif len(pictures) == 4:
-        new_width = max(widths) * 2 + inter_width * 3
-        new_height = max(heights) * 2 + inter_width * 3
-    else:
-        raise ValueError("List of max 4 pictures expected, got {}".format(len(pictures)))
-
-    matrix = Image.new('RGBA', (new_width, new_height))
-
-    x_offset = inter_width
-    y_offset = inter_width
-
-    # Consider that the photo are correctly ordered
-    matrix.paste(pictures[0], (x_offset, y_offset))
-    if len(pictures) == 2:
-        y_offset += (pictures[0].size[1] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-    elif len(pictures) == 3:
-        y_offset += (pictures[0].size[1] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-        y_offset += (pictures[1].size[1] + inter_width)
-        matrix.paste(pictures[2], (x_offset, y_offset))
-    elif len(pictures) == 4:
-        x_offset += (pictures[0].size[0] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-        y_offset += (pictures[1].size[1] + inter_width)
-        x_offset = inter_width
-        matrix.paste(pictures[2], (x_offset, y_offset))
-        x_offset += (pictures[2].size[0] + inter_width)
-        matrix.paste(pictures[3], (x_offset, y_offset))
-
-    final_width, final_height = 2400, 3600
-    if not footer_texts[0] and not footer_texts[1]:
-        matrix_width, matrix_height = final_width, final_height
-        footer_size = 0
-    else:
-        matrix_width, matrix_height = 2400, 3000
-        footer_size = 600
+    draw = ImageDraw.Draw(image)
+    for box, text in zip(texts_boxes, footer_texts):
+        if not text:
+            continue
+        font = fonts.get_font(box.font, box.size)
+        text_width, text_height = draw.textsize(text, font=font)
+        x, y, width, height = box.box
+        footer_x = x + width // 2 - text_width // 2
+        if box.valign == 'middle':
+            footer_y = y + height // 2 - text_height // 2
+        else:
+            footer_y = y
+        draw.text((footer_x, footer_y), text, text_color, font=font)
 
-    matrix = matrix.resize(sizing.new_size_keep_aspect_ratio(
-        matrix.size, (matrix_width, matrix_height)), Image.ANTIALIAS)
-    final_image = new_image_with_background(final_width, final_height, bg_color)
-    final_image.paste(matrix, ((final_width - matrix.size[0]) // 2,
-                               (final_height - footer_size - matrix.size[1]) // 2), mask=matrix)
 
-    if footer_size:
-        # Text part
-        draw = ImageDraw.Draw(final_image)
+def get_base_image(geometry, background, footer_texts, text_color):
+    """Return the final picture without the captures: the background and the
+    footer texts. The image is rendered only once for a given set of
+    parameters, thus it shall be copied before being modified.
 
-        # Footer 1
-        name_font = ImageFont.truetype(fonts.get_filename("Amatic-Bold.ttf"), int(2 / 3. * footer_size))
-        name_width, name_height = draw.textsize(footer_texts[0], font=name_font)
-        footer_x = (final_width - name_width) // 2
-        footer_y = final_height - footer_size - 100
-        draw.text((footer_x, footer_y), footer_texts[0], text_color, font=name_font)
+    A background given as PIL image can not be identified, in this case the
+    image is rendered at each call.
+    """
+    if isinstance(background, (tuple, list)):
+        bg_key = tuple(background)
+    elif isinstance(background, Image.Image):
+        bg_key = None
+    else:
+        # The image file may be modified
+        bg_key = (background, osp.getmtime(background))
+
+    key = (geometry.size, geometry.texts, tuple(footer_texts), tuple(text_color), bg_key)
+    with _BASE_IMAGES_LOCK:
+        if bg_key is not None and key in _BASE_IMAGES:
+            _BASE_IMAGES[key] = _BASE_IMAGES.pop(key)  # Most recently used at the end
+            return _BASE_IMAGES[key]
+
+        LOGGER.debug("Render base image %sx%s (background and footer)", *geometry.size)
+        image = new_image_with_background(geometry.size[0], geometry.size[1], background)
+        if geometry.texts:
+            draw_footer(image, geometry.texts, footer_texts, text_color)
+
+        if bg_key is not None:
+            _BASE_IMAGES[key] = image
+            while len(_BASE_IMAGES) > _BASE_IMAGES_MAX:
+                _BASE_IMAGES.popitem(last=False)
+        return image
 
-        # Footer 2
-        date_font = ImageFont.truetype(fonts.get_filename("AmaticSC-Regular.ttf"), int(1 / 3. * footer_size))
-        date_width, date_height = draw.textsize(footer_texts[1], font=date_font)
-        footer_x = (final_width - date_width) // 2
-        footer_y = final_height - footer_size + 300
-        draw.text((footer_x, footer_y), footer_texts[1], text_color, font=date_font)
 
-    return final_image
+class IncrementalCompositor(object):
 
+    """Build the final picture step by step: each picture is resized to its
+    final size and pasted at its place (on a copy of the pre-rendered base
+    image) as soon as it is added, thus nothing remains to be done when the
+    last picture is available.
 
-def concatenate_pictures_landscape(pictures, footer_texts, bg_color, text_color, inter_width=None):
-    """
-    Merge up to 4 PIL images in landscape orientation.
-
-      +-------------+     +-------------+     +-------------+     +---+-+-+-+---+
-      |     +-+     |     |   +-+  +-+  |     | +-+ +-+ +-+ |     |   |1| |2|   |
-      |     |1|     |     |   |1|  |2|  |     | |1| |2| |3| |     |   +-+ +-+   |
-      |     +-+     |     |   +-+  +-+  |     | +-+ +-+ +-+ |     |   +-+ +-+   |
-      |             |     |             |     |             |     |   |3| |4|   |
-      +-------------+     +-------------+     +-------------+     +---+-+-+-+---+
+    The pictures are added in the order of the final layout unless their
+    index is given.
     """
-    widths, heights = zip(*(i.size for i in pictures))
-
-    # starting here we consider that all the images have the same height and widths
-    if inter_width is None:
-        inter_width = max(heights) // 20
-
-    if len(pictures) == 1:
-        new_width = max(widths) + inter_width * 2
-        new_height = max(heights) + inter_width * 2
-    elif len(pictures) == 2:
-        new_width = max(widths) * 2 + inter_width * 3
-        new_height = max(heights) + inter_width * 2
-    elif len(pictures) == 3:
-        new_width = max(widths) * 3 + inter_width * 4
-        new_height = max(heights) + inter_width * 2
-    elif len(pictures) == 4:
-        new_width = max(widths) * 2 + inter_width * 3
-        new_height = max(heights) * 2 + inter_width * 3
-    else:
-        raise ValueError("List of max 4 pictures expected, got {}".format(len(pictures)))
-
-    matrix = Image.new('RGBA', (new_width, new_height))
-
-    x_offset = inter_width
-    y_offset = inter_width
-
-    # Consider that the photo are correctly ordered
-    matrix.paste(pictures[0], (x_offset, y_offset))
-    if len(pictures) == 2:
-        x_offset += (pictures[0].size[0] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-    elif len(pictures) == 3:
-        x_offset += (pictures[0].size[0] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-        x_offset += (pictures[1].size[0] + inter_width)
-        matrix.paste(pictures[2], (x_offset, y_offset))
-    elif len(pictures) == 4:
-        x_offset += (pictures[0].size[0] + inter_width)
-        matrix.paste(pictures[1], (x_offset, y_offset))
-        y_offset += (pictures[1].size[1] + inter_width)
-        x_offset = inter_width
-        matrix.paste(pictures[2], (x_offset, y_offset))
-        x_offset += (pictures[2].size[0] + inter_width)
-        matrix.paste(pictures[3], (x_offset, y_offset))
-
-    final_width, final_height = 3600, 2400
-    if not footer_texts[0] and not footer_texts[1]:
-        matrix_width, matrix_height = final_width, final_height
-        footer_size = 0
-    else:
-        matrix_width, matrix_height = 3600, 2100
-        footer_size = 300
 
-    matrix = matrix.resize(sizing.new_size_keep_aspect_ratio(
-        matrix.size, (matrix_width, matrix_height)), Image.ANTIALIAS)
-    final_image = new_image_with_background(final_width, final_height, bg_color)
-    final_image.paste(matrix, ((final_width - matrix.size[0]) // 2,
-                               (final_height - footer_size - matrix.size[1]) // 2), mask=matrix)
+    def __init__(self, nbr_pictures, footer_texts=('', ''), bg_color=(255, 255, 255), text_color=(0, 0, 0),
+                 orientation="auto", inter_width=None):
+        if nbr_pictures < 1:
+            raise ValueError("At least 1 picture expected, got {}".format(nbr_pictures))
+        if orientation not in ("auto", "revauto", "portrait", "landscape"):
+            raise ValueError("Invalid orientation '{}'".format(orientation))
+        self.nbr_pictures = nbr_pictures
+        self.footer_texts = footer_texts
+        self.bg_color = bg_color
+        self.text_color = text_color
+        self.orientation = orientation
+        self.inter_width = inter_width
+        self.count = 0
+
+        self._image = None
+        self._geometry = None
+        self._indexes = set()
+        self._lock = threading.Lock()
+
+    def _setup(self, picture_size):
+        """Create the final image according to the size of the first picture.
+        """
+        if self.orientation == "auto":
+            # Use the size of the first picture to determine the orientation
+            if picture_size[0] > picture_size[1]:
+                self.orientation = "landscape"
+            else:
+                self.orientation = "portrait"
+        elif self.orientation == "revauto":
+            # Use the size of the first picture to determine the reversed orientation
+            if picture_size[0] < picture_size[1]:
+                self.orientation = "landscape"
+            else:
+                self.orientation = "portrait"
+
+        # Starting here we consider that all the images have the same height and widths
+        if self.inter_width is None:
+            self.inter_width = picture_size[1] // 20
+
+        self._geometry = layout.get_geometry(self.orientation, self.nbr_pictures, picture_size,
+                                             self.inter_width, any(self.footer_texts))
+        self._image = get_base_image(self._geometry, self.bg_color, self.footer_texts, self.text_color).copy()
+
+    def get_slot_size(self, picture_size, index=0):
+        """Return the size of the place of the given picture index in the
+        final picture. The layout is determined from the given picture size
+        if no picture has been added yet.
+        """
+        with self._lock:
+            if self._image is None:
+                self._setup(picture_size)
+            return self._geometry.slots[index][2:]
+
+    def is_complete(self):
+        """Return True if all pictures have been added.
+        """
+        return self.count == self.nbr_pictures
+
+    def add_picture(self, picture, index=None):
+        """Resize the given PIL image and paste it at its place in the final
+        picture. The `index` is the place of the picture in the layout (next
+        free place if None). Pictures can be added from several threads.
+        """
+        with self._lock:
+            if index is None:
+                index = self.count
+            if self.is_complete():
+                raise ValueError("All the {} pictures are already added".format(self.nbr_pictures))
+            if index in self._indexes or not 0 <= index < self.nbr_pictures:
+                raise ValueError("Invalid picture index {}".format(index))
+            self._indexes.add(index)
+            if self._image is None:
+                self._setup(picture.size)
+            x, y, width, height = self._geometry.slots[index]
+
+        # Resize out of the lock to resize several pictures in parallel
+        picture = picture.resize((width, height), Image.ANTIALIAS)
+
+        with self._lock:
+            if picture.mode == 'RGBA':
+                self._image.paste(picture, (x, y), mask=picture)
+            else:
+                self._image.paste(picture, (x, y))
+            self.count += 1
+
+    def build(self):
+        """Return the final picture as a PIL image object.
+        """
+        if not self.is_complete():
+            raise ValueError("Only {} of the {} pictures are added".format(self.count, self.nbr_pictures))
+        return self._image
 
-    if footer_size:
-        # Text part
-        draw = ImageDraw.Draw(final_image)
 
-        # Footer 1
-        name_font = ImageFont.truetype(fonts.get_filename("Amatic-Bold.ttf"), int(2 / 3. * footer_size))
-        name_width, name_height = draw.textsize(footer_texts[0], font=name_font)
-        footer_x = final_width // 4 - name_width // 2
-        footer_y = final_height - (footer_size + name_height) // 2 - 50
-        draw.text((footer_x, footer_y), footer_texts[0], text_color, font=name_font)
+def concatenate_pictures_portrait(pictures, footer_texts, bg_color, text_color, inter_width=None):
+    """
+    Merge PIL images in portrait orientation.
+    """
+    return concatenate_pictures(pictures, footer_texts, bg_color, text_color, "portrait", inter_width)
 
-        # Footer 2
-        date_font = ImageFont.truetype(fonts.get_filename("AmaticSC-Regular.ttf"), int(1 / 3. * footer_size))
-        date_width, date_height = draw.textsize(footer_texts[1], font=date_font)
-        footer_x = 3 * final_width // 4 - date_width // 2
-        footer_y = final_height - (footer_size + date_height) // 2 - 50
-        draw.text((footer_x, footer_y), footer_texts[1], text_color, font=date_font)
 
-    return final_image
+def concatenate_pictures_landscape(pictures, footer_texts, bg_color, text_color, inter_width=None):
+    """
+    Merge PIL images in landscape orientation.
+    """
+    return concatenate_pictures(pictures, footer_texts, bg_color, text_color, "landscape", inter_width)
 
 
 def concatenate_pictures(pictures, footer_texts=('', ''), bg_color=(255, 255, 255), text_color=(0, 0, 0), orientation="auto", inter_width=None):
     """
-    Merge up to 4 PIL images and retrun concatenated image as a new PIL image object.
-    Configuration of the final picture depends on the number of given pictures.
+    Merge PIL images and retrun concatenated image as a new PIL image object.
+    Configuration of the final picture depends on the number of given pictures
+    (see the layouts templates defined in :py:mod:`pibooth.pictures.layout`).
     """
-    if orientation == "auto":
-        # Use the size of the first picture to determine the orientation
-        if pictures[0].size[0] > pictures[0].size[1]:
-            orientation = "landscape"
-        else:
-            orientation = "portrait"
-    elif orientation == "revauto":
-        # Use the size of the first picture to determine the reversed orientation
-        if pictures[0].size[0] < pictures[0].size[1]:
-            orientation = "landscape"
-        else:
-            orientation = "portrait"
-
-    if orientation == "portrait":
-        return concatenate_pictures_portrait(pictures, footer_texts, bg_color, text_color, inter_width)
-    elif orientation == "landscape":
-        return concatenate_pictures_landscape(pictures, footer_texts, bg_color, text_color, inter_width)
-    else:
-        raise ValueError("Invalid orientation '{}'".format(orientation))
+    compositor = IncrementalCompositor(len(pictures), footer_texts, bg_color, text_color,
+                                       orientation, inter_width)
+    for picture in pictures:
+        compositor.add_picture(picture)
+    return compositor.build()
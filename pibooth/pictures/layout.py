@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth final picture layouts.
+
+The layouts are defined as templates in the ``layouts.json`` file. Each
+template (one per orientation) gives:
+
+    * ``size``: the (width, height) of the final picture
+    * ``grids``: the (columns, rows) of the grid used to place the captures,
+      given for each number of captures. The captures are placed row by row.
+    * ``footer``: the ``height`` of the footer area at the bottom of the final
+      picture and the definition of the ``texts`` boxes (font, size, box
+      rectangle and vertical alignment).
+
+    Portrait:
+
+      +---------+     +---------+     +---+-+---+     +---------+
+      |         |     |   +-+   |     |   |1|   |     | +-+ +-+ |
+      |         |     |   |1|   |     |   +-+   |     | |1| |2| |
+      |   +-+   |     |   +-+   |     |   +-+   |     | +-+ +-+ |
+      |   |1|   |     |         |     |   |2|   |     |         |
+      |   +-+   |     |   +-+   |     |   +-+   |     | +-+ +-+ |
+      |         |     |   |2|   |     |   +-+   |     | |3| |4| |
+      |         |     |   +-+   |     |   |3|   |     | +-+ +-+ |
+      +---------+     +---------+     +---+-+---+     +---------+
+
+    Landscape:
+
+      +-------------+     +-------------+     +-------------+     +---+-+-+-+---+
+      |     +-+     |     |   +-+  +-+  |     | +-+ +-+ +-+ |     |   |1| |2|   |
+      |     |1|     |     |   |1|  |2|  |     | |1| |2| |3| |     |   +-+ +-+   |
+      |     +-+     |     |   +-+  +-+  |     | +-+ +-+ +-+ |     |   +-+ +-+   |
+      |             |     |             |     |             |     |   |3| |4|   |
+      +-------------+     +-------------+     +-------------+     +---+-+-+-+---+
+"""
+
+import json
+import os.path as osp
+from collections import namedtuple
+from pibooth.utils import LOGGER
+from pibooth.pictures import sizing
+
+
+TEMPLATES_FILE = osp.join(osp.dirname(osp.abspath(__file__)), 'layouts.json')
+
+FooterText = namedtuple('FooterText', ('font', 'size', 'box', 'valign'))
+
+Geometry = namedtuple('Geometry', ('size', 'footer_height', 'slots', 'texts'))
+
+_TEMPLATES = {}
+
+_GEOMETRIES = {}
+
+
+def load_templates(filename=TEMPLATES_FILE):
+    """Load the layouts templates from the given file (drop the geometries
+    computed with the previous templates).
+    """
+    LOGGER.debug("Load layouts templates from '%s'", filename)
+    with open(filename) as fp:
+        templates = json.load(fp)
+    _TEMPLATES.clear()
+    _GEOMETRIES.clear()
+    for name, template in templates.items():
+        _TEMPLATES[name] = template
+
+
+def get_template(name):
+    """Return the template definition for the given name.
+    """
+    if not _TEMPLATES:
+        load_templates()
+    if name not in _TEMPLATES:
+        raise ValueError("Invalid layout template '{}'".format(name))
+    return _TEMPLATES[name]
+
+
+def get_supported_captures(name):
+    """Return the numbers of captures supported by the given template.
+    """
+    return sorted(int(nbr) for nbr in get_template(name)['grids'])
+
+
+def get_geometry(name, nbr_pictures, picture_size, inter_width, footer=True):
+    """Return the geometry of the final picture: its size, the height of the
+    footer, the rectangles (x, y, width, height) where each picture shall be
+    placed and the footer texts boxes.
+
+    The slots are computed as if the matrix of pictures (separated by
+    ``inter_width`` pixels) was resized to fit the area above the footer,
+    thus each picture can be resized directly to its final size.
+
+    The geometry is computed only once for each set of parameters.
+    """
+    key = (name, nbr_pictures, tuple(picture_size), inter_width, bool(footer))
+    if key in _GEOMETRIES:
+        return _GEOMETRIES[key]
+
+    template = get_template(name)
+    grid = template['grids'].get(str(nbr_pictures))
+    if not grid:
+        raise ValueError("Layout template '{}' supports {} pictures, got {}".format(
+            name, get_supported_captures(name), nbr_pictures))
+
+    final_size = tuple(template['size'])
+    if footer:
+        footer_height = template['footer']['height']
+        texts = tuple(FooterText(text['font'], text['size'], tuple(text['box']), text.get('valign', 'top'))
+                      for text in template['footer']['texts'])
+    else:
+        footer_height = 0
+        texts = ()
+
+    # Size of the matrix containing all pictures
+    columns, rows = grid
+    width, height = picture_size
+    matrix_size = (width * columns + inter_width * (columns + 1),
+                   height * rows + inter_width * (rows + 1))
+
+    new_width, new_height = sizing.new_size_keep_aspect_ratio(matrix_size,
+                                                              (final_size[0], final_size[1] - footer_height))
+    x_ratio = new_width / float(matrix_size[0])
+    y_ratio = new_height / float(matrix_size[1])
+    x_offset = (final_size[0] - new_width) // 2
+    y_offset = (final_size[1] - footer_height - new_height) // 2
+
+    slots = []
+    for index in range(nbr_pictures):
+        x = inter_width + (index % columns) * (width + inter_width)
+        y = inter_width + (index // columns) * (height + inter_width)
+        left, top = int(round(x * x_ratio)), int(round(y * y_ratio))
+        right, bottom = int(round((x + width) * x_ratio)), int(round((y + height) * y_ratio))
+        slots.append((x_offset + left, y_offset + top, right - left, bottom - top))
+
+    geometry = Geometry(final_size, footer_height, tuple(slots), texts)
+    _GEOMETRIES[key] = geometry
+    return geometry
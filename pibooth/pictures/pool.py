@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth pictures processing pool.
+"""
+
+import multiprocessing
+from concurrent import futures
+from pibooth.utils import LOGGER
+
+
+class PicturesPool(object):
+
+    """Execute the pictures processing (concatenation, saving...) in
+    separated threads to keep the pygame main loop responsive.
+    Jobs are started in the order they are submitted, by default there is
+    one worker per CPU core.
+    """
+
+    def __init__(self, max_workers=None):
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers or multiprocessing.cpu_count())
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule the callable to be executed as ``func(*args, **kwargs)``
+        and return a ``Future`` object representing its execution.
+        """
+        LOGGER.debug("Submit job '%s' to the pictures pool", getattr(func, '__name__', func))
+        return self._executor.submit(self._run, func, *args, **kwargs)
+
+    def _run(self, func, *args, **kwargs):
+        """Execute the job, the error is logged because the future may be
+        never consulted (the exception is still raised to the future).
+        """
+        try:
+            return func(*args, **kwargs)
+        except Exception as ex:
+            LOGGER.error("Job '%s' failed in the pictures pool: %s", getattr(func, '__name__', func), ex)
+            raise
+
+    def wait(self, jobs):
+        """Wait for the given jobs to be finished and raise the first error
+        which occurred (if any).
+        """
+        for job in jobs:
+            job.result()
+
+    def quit(self):
+        """Wait for the pending jobs and release the resources.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth QR codes generation.
+"""
+
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict as odict
+from PIL import Image
+try:
+    import qrcode
+except ImportError:
+    qrcode = None  # qrcode is optional
+
+
+# QR code images by (url, box size, border), the oldest ones are dropped
+_QRCODES = odict()
+_QRCODES_MAX = 8
+_QRCODES_LOCK = threading.Lock()
+
+
+def is_available():
+    """Return True if the QR codes can be generated.
+    """
+    return qrcode is not None
+
+
+def get_qrcode(url, box_size=10, border=2):
+    """Return a PIL image (RGB) of the QR code encoding the given URL. The
+    modules are drawn without interpolation, so the image is ready to be
+    displayed. The image is generated only once for a given URL.
+
+    :param box_size: size in pixels of each module of the QR code
+    :param border: size of the white border (in modules)
+    """
+    if not qrcode:
+        raise EnvironmentError("QR code can not be generated (qrcode not installed)")
+
+    key = (url, box_size, border)
+    with _QRCODES_LOCK:
+        if key in _QRCODES:
+            _QRCODES[key] = _QRCODES.pop(key)  # Most recently used
+            return _QRCODES[key]
+
+    code = qrcode.QRCode(box_size=box_size, border=border)
+    code.add_data(url)
+    code.make(fit=True)
+    matrix = code.get_matrix()  # Modules including the border
+
+    image = Image.new('L', (len(matrix[0]), len(matrix)))
+    image.putdata([0 if module else 255 for row in matrix for module in row])
+    image = image.resize((image.size[0] * box_size, image.size[1] * box_size), Image.NEAREST).convert('RGB')
+
+    with _QRCODES_LOCK:
+        image = _QRCODES.setdefault(key, image)
+        while len(_QRCODES) > _QRCODES_MAX:
+            _QRCODES.popitem(last=False)
+    return image
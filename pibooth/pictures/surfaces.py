@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth conversion of PIL images to pygame surfaces.
+"""
+
+import weakref
+from collections import OrderedDict as odict
+import pygame
+from PIL import Image
+from pibooth.utils import LOGGER
+from pibooth.pictures import sizing
+
+
+def to_surface(image):
+    """Return a pygame surface from the given PIL image. The PIL data are
+    copied once in a bytes buffer shared with the surface (no pixel by pixel
+    conversion), then the surface is converted to the display pixels format
+    (if a display is set) to speed up its blitting.
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        if 'A' in image.mode or 'transparency' in image.info:
+            image = image.convert('RGBA')
+        else:
+            image = image.convert('RGB')
+    surface = pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+    if pygame.display.get_surface():
+        if image.mode == 'RGBA':
+            surface = surface.convert_alpha()
+        else:
+            surface = surface.convert()
+    return surface
+
+
+def get_fingerprint(image):
+    """Return a light hash of the image content (a few pixels sampled).
+    """
+    return hash((image.mode, image.size, image.resize((8, 8), Image.NEAREST).tobytes()))
+
+
+class SurfacesCache(object):
+
+    """Least recently used cache of the pygame surfaces created from PIL
+    images. A surface is identified by its source image (the same object
+    with the same content) and its size. The oldest surfaces are dropped
+    when the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._surfaces = odict()
+        self._bytes = 0
+
+    def get(self, image, size=None, sharp=False):
+        """Return the pygame surface for the given PIL image. If a size is
+        given, the image is resized keeping its aspect ratio. If `sharp` is
+        True, the image is resized by the greatest integer factor fitting
+        in the size, without interpolation (QR code for instance).
+        """
+        key = (id(image), get_fingerprint(image), size, sharp)
+        if key in self._surfaces:
+            source, surface, nbytes = self._surfaces.pop(key)
+            if source() is image:
+                self._surfaces[key] = (source, surface, nbytes)  # Most recently used at the end
+                return surface
+            # Same id but another image (previous one deleted)
+            self._bytes -= nbytes
+
+        LOGGER.debug("Create surface for image '%s' (size=%s)", key[0], size)
+        if size and sharp:
+            factor = max(1, min(size[0] // image.size[0], size[1] // image.size[1]))
+            resized = image.resize((image.size[0] * factor, image.size[1] * factor), Image.NEAREST)
+        elif size:
+            resized = image.resize(sizing.new_size_keep_aspect_ratio(image.size, size), Image.ANTIALIAS)
+        else:
+            resized = image
+        surface = to_surface(resized)
+        nbytes = surface.get_bytesize() * surface.get_width() * surface.get_height()
+
+        self._surfaces[key] = (weakref.ref(image), surface, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes and len(self._surfaces) > 1:
+            _key, (_source, _surface, old_nbytes) = self._surfaces.popitem(last=False)
+            self._bytes -= old_nbytes
+        return surface
+
+    def clear(self):
+        """Drop all surfaces.
+        """
+        self._surfaces.clear()
+        self._bytes = 0
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth runtime executing the main loop.
+"""
+
+import pygame
+
+
+WAKEUP = pygame.USEREVENT + 2
+
+
+class ThreadsRuntime(object):
+
+    """The main loop waits for the pygame events, the slow I/O operations
+    (executed by the printer, the pictures pool...) wake it up by posting
+    an event when they are done.
+    """
+
+    def wakeup(self):
+        """Force the main loop to process the active state as soon as
+        possible (can be called from any thread).
+        """
+        try:
+            pygame.event.post(pygame.event.Event(WAKEUP))
+        except pygame.error:
+            pass  # Application is stopping
+
+    def watch_future(self, future):
+        """Wake up the main loop when the given future is done.
+        """
+        future.add_done_callback(lambda _: self.wakeup())
+        return future
+
+    def run(self, app):
+        """Run the main loop until the application request to quit.
+        """
+        clock = pygame.time.Clock()
+        while True:
+            # Sleep until an event is received or the active state has
+            # something to do (end of a timer for instance)
+            events = app.wait_events(app.state_machine.get_timeout())
+            if not app.process_events(events):
+                break
+            clock.tick(40)  # Ensure the program will never run at more than x frames per second
+
+    def quit(self):
+        """Release the resources.
+        """
+        pass
@@ -34,6 +34,13 @@ class State(object):
         """
         pass
 
+    def get_timeout(self):
+        """Return the maximum time (in seconds) to wait for new events before
+        processing the state again. Return 0 to process it as soon as possible
+        or None to wait for an event indefinitely.
+        """
+        return 0
+
 
 class StateMachine(object):
 
@@ -56,6 +63,14 @@ class StateMachine(object):
         self.failsafe_state = state
         self.states[state.name] = state
 
+    def get_timeout(self):
+        """Return the maximum time (in seconds) to wait for new events before
+        processing the active state again (None if no limit).
+        """
+        if self.active_state is None:
+            return None
+        return self.active_state.get_timeout()
+
     def process(self, events):
         """Let the current state do it's thing
         """
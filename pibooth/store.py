@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+"""Pibooth sessions storage.
+"""
+
+import io
+import os
+import json
+import errno
+import time
+import shutil
+import threading
+import itertools
+import os.path as osp
+from collections import OrderedDict as odict
+from pibooth.utils import LOGGER
+
+
+class SessionStore(object):
+
+    """Store the pictures of each session (sequence of captures) in its own
+    directory. The sessions are identified by a monotonically increasing
+    number and their directories are sharded to keep a small number of
+    entries per directory::
+
+        <rootdir>/0000/000001_181024153012/
+        <rootdir>/0000/000002_181024153047/
+        ...
+        <rootdir>/0001/000500_181024182310/
+
+    The sessions are recorded in an append-only index (one JSON record per
+    line) giving their path, number of captures, number of printed pages
+    and upload state. The index is compacted when it is loaded.
+    """
+
+    SHARD_SIZE = 500  # Maximum number of sessions per directory
+    INDEX = 'sessions.index'
+
+    def __init__(self, rootdir):
+        self.rootdir = osp.abspath(osp.expanduser(rootdir))
+        self.filename = osp.join(self.rootdir, self.INDEX)
+        self._sessions = odict()  # Session ID: record (ordered by ID)
+        self._paths = {}  # Relative path: session ID
+        self._lock = threading.RLock()
+        self._load()
+        self._counter = max(next(reversed(self._sessions)) if self._sessions else 0, self._scan_last_id())
+
+    def _load(self):
+        """Read the index and compact it.
+        """
+        if not osp.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+
+        if osp.isfile(self.filename):
+            with io.open(self.filename, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Truncated line (power loss during write)
+                    session_id = record.pop('id')
+                    if record.pop('op', None) == 'del':
+                        self._sessions.pop(session_id, None)
+                    else:
+                        self._sessions.setdefault(session_id, {'id': session_id}).update(record)
+
+        # IDs are increasing: the records may be unordered only if the
+        # index was modified by hand (the records without path are the
+        # ones for which the creation line was truncated)
+        self._sessions = odict(item for item in sorted(self._sessions.items()) if 'path' in item[1])
+        self._paths = dict((record['path'], session_id) for session_id, record in self._sessions.items())
+
+        tmp = self.filename + '.tmp'
+        with io.open(tmp, 'w', encoding='utf-8') as fp:
+            for record in self._sessions.values():
+                fp.write(self._dumps(record))
+        os.rename(tmp, self.filename)
+        LOGGER.debug("Sessions index '%s' loaded (%s sessions)", self.filename, len(self._sessions))
+
+    def _scan_last_id(self):
+        """Return the highest session ID found in the last shard directory
+        (the index may be lost or older than the directories).
+        """
+        shards = [name for name in os.listdir(self.rootdir)
+                  if name.isdigit() and osp.isdir(osp.join(self.rootdir, name))]
+        if not shards:
+            return 0
+        ids = [int(name.split('_')[0]) for name in os.listdir(osp.join(self.rootdir, max(shards, key=int)))
+               if name.split('_')[0].isdigit()]
+        return max(ids) if ids else 0
+
+    def _dumps(self, record):
+        """Return the index line for the given record.
+        """
+        line = json.dumps(record, sort_keys=True) + '\n'
+        return line if isinstance(line, type(u'')) else line.decode('utf-8')
+
+    def _append(self, record):
+        """Append a record, flushed to the disk to survive a power loss.
+        """
+        with io.open(self.filename, 'a', encoding='utf-8') as fp:
+            fp.write(self._dumps(record))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self):
+        """Create the directory of a new session and return its ID.
+        """
+        with self._lock:
+            while True:
+                self._counter += 1
+                path = '{:04}/{:06}_{}'.format(self._counter // self.SHARD_SIZE, self._counter,
+                                               time.strftime("%y%m%d%H%M%S"))
+                try:
+                    os.makedirs(osp.join(self.rootdir, path))
+                    break
+                except OSError:
+                    if not osp.isdir(osp.join(self.rootdir, path)):
+                        raise
+                    # Directory not indexed (index removed), take the next ID
+
+            record = {'id': self._counter, 'path': path, 'time': time.time(),
+                      'captures': 0, 'printed': 0, 'uploaded': None}
+            self._sessions[self._counter] = record
+            self._paths[path] = self._counter
+            self._append(record)
+            LOGGER.debug("Session %s created in '%s'", self._counter, path)
+            return self._counter
+
+    def update(self, session_id, **fields):
+        """Update the given fields (``captures``, ``printed``, ``uploaded``)
+        of the session.
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                return  # Removed meanwhile
+            self._sessions[session_id].update(fields)
+            fields['id'] = session_id
+            self._append(fields)
+
+    def remove(self, session_id):
+        """Remove the session from the index (the files are not deleted) and
+        return its record.
+        """
+        with self._lock:
+            record = self._sessions.pop(session_id)
+            self._paths.pop(record['path'], None)
+            self._append({'id': session_id, 'op': 'del'})
+            return dict(record)
+
+    def get(self, session_id):
+        """Return a copy of the session record.
+        """
+        with self._lock:
+            return dict(self._sessions[session_id])
+
+    def get_last(self, count=1):
+        """Return the records of the last sessions, the most recent first.
+        """
+        with self._lock:
+            return [dict(record) for record in itertools.islice(reversed(self._sessions.values()), count)]
+
+    def get_first(self, count=1):
+        """Return the records of the oldest sessions, the oldest first.
+        """
+        with self._lock:
+            return [dict(record) for record in itertools.islice(self._sessions.values(), count)]
+
+    def get_dirname(self, session_id):
+        """Return the directory of the session.
+        """
+        return osp.join(self.rootdir, self._sessions[session_id]['path'])
+
+    def get_picture_filename(self, session_id):
+        """Return the path to the final picture of the session.
+        """
+        return osp.join(self.get_dirname(session_id), osp.basename(self._sessions[session_id]['path']) + '.jpg')
+
+    def get_capture_filename(self, session_id, index):
+        """Return the path to a capture of the session.
+        """
+        return osp.join(self.get_dirname(session_id), "pibooth{:03}.jpg".format(index))
+
+    def find(self, filename):
+        """Return the ID of the session containing the given file (None if
+        the file is not in a session directory).
+        """
+        path = osp.relpath(osp.dirname(osp.abspath(filename)), self.rootdir).replace(os.sep, '/')
+        return self._paths.get(path)
+
+
+def _get_cleared_name(prefix):
+    """Return a path starting with the given prefix followed by the
+    current date, which does not exist yet.
+    """
+    cleared = '{}.cleared-{}'.format(prefix, time.strftime("%Y%m%d%H%M%S"))
+    count = 0
+    while osp.exists(cleared):
+        count += 1
+        cleared = '{}.cleared-{}-{}'.format(prefix, time.strftime("%Y%m%d%H%M%S"), count)
+    return cleared
+
+
+def clear_directory(dirname):
+    """Move the directory aside (atomic rename) to be removed later by the
+    :py:class:`SessionCleaner`, and create a new empty one. If the directory
+    can not be renamed (mount point), its content is moved in a
+    ``.cleared-*`` sub-directory instead. Return the path where the old
+    content has been moved.
+    """
+    dirname = osp.abspath(osp.expanduser(dirname)).rstrip(os.sep)
+    cleared = _get_cleared_name(dirname)
+    try:
+        os.rename(dirname, cleared)
+    except OSError as ex:
+        if ex.errno != errno.EBUSY:
+            raise
+        cleared = _get_cleared_name(osp.join(dirname, ''))
+        os.makedirs(cleared)
+        for name in os.listdir(dirname):
+            if not name.startswith('.cleared-'):
+                os.rename(osp.join(dirname, name), osp.join(cleared, name))
+    else:
+        os.makedirs(dirname)
+    LOGGER.info("Directory '%s' cleared (moved to '%s')", dirname, cleared)
+    return cleared
+
+
+class SessionCleaner(object):
+
+    """Remove the cleared directories and apply the retention policy in a
+    low priority thread. The oldest sessions are removed when there are
+    more than `keep_sessions` sessions or when the sessions use more than
+    `max_usage` bytes (0 for unlimited), except the sessions waiting to
+    be uploaded. The captures of the finished sessions are removed if
+    `keep_only_finals` is True. The removed directories are moved in
+    `archive_dir` if defined.
+    """
+
+    CHUNK_SIZE = 20  # Number of files removed before yielding to the other threads
+
+    def __init__(self, store, keep_sessions=0, max_usage=0, keep_only_finals=False, archive_dir=None):
+        self.store = store
+        self.keep_sessions = keep_sessions
+        self.max_usage = max_usage
+        self.keep_only_finals = keep_only_finals
+        self.archive_dir = osp.abspath(osp.expanduser(archive_dir)) if archive_dir else None
+        # Directories cleared aside or inside the root one (mount point) as
+        # (path, archive name)
+        parent, prefix = osp.split(store.rootdir + '.cleared-')
+        self._cleared = sorted((osp.join(parent, name), name) for name in os.listdir(parent)
+                               if name.startswith(prefix))
+        self._cleared += sorted((osp.join(store.rootdir, name), prefix + name[len('.cleared-'):])
+                                for name in os.listdir(store.rootdir) if name.startswith('.cleared-'))
+        self._finished = []  # Sessions to measure
+        self._refresh = True  # Apply the retention policy at startup
+        self._usage = sum(record.get('size', 0) for record in store.get_first(len(store)))
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        """Clean until stop is requested.
+        """
+        try:
+            # Lowest priority for this thread only (the threads have their
+            # own priority on Linux)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while not self._stop_event.is_set():
+            with self._condition:
+                while not self._refresh and not self._finished and not self._cleared \
+                        and not self._stop_event.is_set():
+                    self._condition.wait()
+                finished, self._finished = self._finished, []
+                cleared, self._cleared = self._cleared, []
+                refresh, self._refresh = self._refresh, False
+
+            try:
+                for session_id in finished:
+                    self._measure(session_id)
+                if finished or refresh:
+                    self._apply_policy()
+                for dirname, name in cleared:
+                    self._remove_tree(dirname, name)
+            except Exception as ex:
+                LOGGER.error("Cleanup of the pictures failed: %s", ex)
+
+    def _measure(self, session_id):
+        """Record the disk usage of the finished session (captures removed
+        if only the final pictures are kept).
+        """
+        try:
+            dirname = self.store.get_dirname(session_id)
+            picture = self.store.get_picture_filename(session_id)
+        except KeyError:
+            return  # Removed meanwhile
+
+        size = 0
+        for name in os.listdir(dirname):
+            path = osp.join(dirname, name)
+            if self.keep_only_finals and path != picture:
+                os.remove(path)
+            else:
+                size += osp.getsize(path)
+        self.store.update(session_id, size=size)
+        self._usage += size
+
+    def _apply_policy(self):
+        """Remove the oldest sessions while the retention policy is exceeded.
+        The last session and the sessions waiting to be uploaded are kept
+        (the policy is applied again once they are uploaded).
+        """
+        count = len(self.store)
+        pending = 0
+        for record in self.store.get_first(max(count - 1, 0)):
+            if self.keep_sessions and count > self.keep_sessions:
+                reason = "more than {} sessions".format(self.keep_sessions)
+            elif self.max_usage and self._usage > self.max_usage:
+                reason = "{} bytes used".format(self._usage)
+            else:
+                break
+            if self._stop_event.is_set():
+                return
+            if record.get('uploaded') is False:
+                pending += 1
+                continue
+
+            self.store.remove(record['id'])
+            count -= 1
+            self._usage -= record.get('size', 0)
+            LOGGER.info("Remove session %s (%s)", record['id'], reason)
+            self._remove_tree(osp.join(self.store.rootdir, record['path']), record['path'])
+        else:
+            if pending:
+                LOGGER.warning("Retention policy exceeded, %s session(s) kept until they are uploaded", pending)
+
+    def refresh(self):
+        """Apply the retention policy again (when a session is uploaded).
+        """
+        with self._condition:
+            self._refresh = True
+            self._condition.notify()
+
+    def _remove_tree(self, dirname, name):
+        """Remove (or archive with the given name) the directory. The files
+        are removed by chunks to let the other threads access the disk.
+        """
+        if not osp.isdir(dirname):
+            return
+        if self.archive_dir:
+            archive = osp.join(self.archive_dir, name)
+            if not osp.isdir(osp.dirname(archive)):
+                os.makedirs(osp.dirname(archive))
+            shutil.move(dirname, archive)
+            return
+
+        count = 0
+        for root, dirs, files in os.walk(dirname, topdown=False):
+            for name in files:
+                os.remove(osp.join(root, name))
+                count += 1
+                if count % self.CHUNK_SIZE == 0 and self._stop_event.wait(0.05):
+                    return  # Resumed at next start (cleared directory) or left on disk
+            for name in dirs:
+                os.rmdir(osp.join(root, name))
+        os.rmdir(dirname)
+        LOGGER.debug("Directory '%s' removed (%s files)", dirname, count)
+
+    def add_session(self, session_id):
+        """Apply the retention policy once the session is finished (its
+        final picture saved).
+        """
+        with self._condition:
+            self._finished.append(session_id)
+            self._condition.notify()
+
+    def get_usage(self):
+        """Return the disk usage (in bytes) of the finished sessions.
+        """
+        return self._usage
+
+    def quit(self):
+        """Stop the cleanup, the cleared directories not fully removed are
+        removed at next start.
+        """
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._worker.join(1)
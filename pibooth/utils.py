@@ -13,6 +13,12 @@ import contextlib
 
 LOGGER = logging.getLogger("pibooth")
 
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2.x fallback
+    monotonic = time.time
+
 
 class BlockConsoleHandler(logging.StreamHandler):
 
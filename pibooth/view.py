@@ -7,10 +7,9 @@ import time
 import contextlib
 import pygame
 from pygame import gfxdraw
-from PIL import Image
+from pibooth import pictures
 from pibooth.pictures import background
-from pibooth.utils import LOGGER
-from pibooth.pictures import sizing
+from pibooth.pictures.surfaces import SurfacesCache
 
 
 class PtbWindow(object):
@@ -36,9 +35,11 @@ class PtbWindow(object):
         self.surface = pygame.display.set_mode(self.__size, pygame.RESIZABLE)
 
         self._buffered_images = {}
+        self._surfaces = SurfacesCache()
         self._current_background = None
         self._current_foreground = None
         self._picture_number = (0, 4)  # (current, max)
+        self._rendered_state = None  # Last state sent to the display
 
         self._pos_map = {self.CENTER: self._center_pos,
                          self.RIGHT: self._right_pos,
@@ -46,43 +47,39 @@ class PtbWindow(object):
 
         if isinstance(size, str) and size.lower() == 'fullscreen':
             self.toggle_fullscreen()
+        else:
+            pictures.preload_images(self.size)
 
-    def _update_foreground(self, pil_image, pos=CENTER, resize=True):
-        """Show a PIL image on the foreground.
-        Only once is bufferized to avoid memory leak.
+    def _update_foreground(self, pil_image, pos=CENTER, resize=True, sharp=False):
+        """Set the PIL image to show on the foreground (None to clear it).
         """
-        image_name = id(pil_image)
-
-        image_size_max = (2 * self.size[1] // 3, self.size[1])
-
-        buff_size, buff_image = self._buffered_images.get(image_name, (None, None))
-        if buff_image and image_size_max == buff_size:
-            image = buff_image
-            LOGGER.debug("Use buffered image '%s'", image_name)
+        if pil_image is None:
+            self._current_foreground = None
         else:
-            if resize:
-                image = pil_image.resize(sizing.new_size_keep_aspect_ratio(pil_image.size, image_size_max), Image.ANTIALIAS)
-            else:
-                image = pil_image
-            image = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
-            if self._current_foreground:
-                self._buffered_images.pop(id(self._current_foreground[0]), None)
-            LOGGER.debug("Add to buffer the image '%s'", image_name)
-            self._buffered_images[image_name] = (image_size_max, image)
-
-        self._current_foreground = (pil_image, pos, resize)
-        self.surface.blit(image, self._pos_map[pos](image))
+            self._current_foreground = (pil_image, pos, resize, sharp)
 
     def _update_background(self, bkgd):
-        """Show image on the background.
+        """Set the image to show on the background.
         """
         self._current_background = self._buffered_images.setdefault(str(bkgd), bkgd)
         self._current_background.resize(self.surface)
-        self._current_background.paint(self.surface)
-        self._update_picture_number()
+
+    def _get_foreground(self):
+        """Return the foreground surface and its position (None if no
+        foreground). The converted images are bufferized (the oldest ones
+        are dropped).
+        """
+        if not self._current_foreground:
+            return None, None
+        pil_image, pos, resize, sharp = self._current_foreground
+        if resize:
+            image = self._surfaces.get(pil_image, (2 * self.size[1] // 3, self.size[1]), sharp)
+        else:
+            image = self._surfaces.get(pil_image)
+        return image, self._pos_map[pos](image)
 
     def _update_picture_number(self):
-        """Update the pictures counter displayed.
+        """Draw the pictures counter.
         """
         if not self._picture_number[0]:
             return  # Dont show counter: no picture taken
@@ -99,6 +96,57 @@ class PtbWindow(object):
                 gfxdraw.filled_circle(self.surface, x, y, radius - 3, color)
             x += (2 * radius + border)
 
+    def _get_picture_number_rect(self):
+        """Return the Rect containing the pictures counter.
+        """
+        radius = 10
+        border = 20
+        width = 2 * radius * self._picture_number[1] + border * (self._picture_number[1] - 1)
+        return pygame.Rect(self.surface.get_rect().centerx - width // 2 - radius - 1,
+                           self.size[1] - 2 * radius - border - 1,
+                           width + 2 * radius + 2, 2 * radius + 2)
+
+    def _paint(self, rect=None):
+        """Paint the background, the pictures counter and the foreground on
+        the given area of the window (whole window if None).
+        """
+        self.surface.set_clip(rect)
+        if self._current_background:
+            self._current_background.paint(self.surface)
+        self._update_picture_number()
+        image, image_rect = self._get_foreground()
+        if image:
+            self.surface.blit(image, image_rect)
+        self.surface.set_clip(None)
+
+    def _render(self, force=False):
+        """Repaint only the areas of the window which have changed since the
+        last rendering and send them to the display. Nothing is done if
+        nothing has changed.
+        """
+        image, image_rect = self._get_foreground()
+        state = (self._current_background, self.surface.get_size(), self._picture_number,
+                 image, tuple(image_rect) if image else None)
+
+        previous = self._rendered_state
+        if force or not previous or previous[:2] != state[:2]:
+            dirty_rects = [self.surface.get_rect()]
+            if self._current_background:
+                # The window may have been resized since the background was set
+                self._current_background.resize(self.surface)
+        else:
+            dirty_rects = []
+            if previous[2] != state[2]:
+                dirty_rects.append(self._get_picture_number_rect())
+            if previous[3] is not state[3] or previous[4] != state[4]:
+                dirty_rects.extend(pygame.Rect(rect) for rect in (previous[4], state[4]) if rect)
+
+        for rect in dirty_rects:
+            self._paint(rect)
+        if dirty_rects:
+            pygame.display.update(dirty_rects)
+        self._rendered_state = state
+
     def _center_pos(self, image):
         """
         Return the position of the given image to be centered on window.
@@ -140,28 +188,25 @@ class PtbWindow(object):
         """
         self.__size = size
         self.surface = pygame.display.set_mode(self.size, pygame.RESIZABLE)
+        pictures.preload_images(self.size)
         self.update()
 
     def update(self):
         """Repaint the window with currently displayed images.
         """
-        if self._current_background:
-            self._update_background(self._current_background)
-        else:
-            self._update_picture_number()
-        if self._current_foreground:
-            self._update_foreground(*self._current_foreground)
-        pygame.display.update()
+        self._render(force=True)
 
     def show_oops(self):
         """Show failure view in case of exception.
         """
         self._picture_number = (0, self._picture_number[1])
         self._update_background(background.OopsBackground())
-        pygame.display.update()
+        self._update_foreground(None)
+        self._render()
 
-    def show_intro(self, pil_image=None, with_print=True):
-        """Show introduction view.
+    def show_intro(self, pil_image=None, with_print=True, sharp=False):
+        """Show introduction view. The image is resized by an integer factor
+        without interpolation if `sharp` is True (QR code for instance).
         """
         self._picture_number = (0, self._picture_number[1])
         if with_print and pil_image:
@@ -169,9 +214,8 @@ class PtbWindow(object):
         else:
             self._update_background(background.IntroBackground())
 
-        if pil_image:
-            self._update_foreground(pil_image, self.RIGHT)
-        pygame.display.update()
+        self._update_foreground(pil_image, self.RIGHT, sharp=sharp)
+        self._render()
 
     def show_choice(self, choices, selected=None):
         """Show the choice view.
@@ -182,63 +226,45 @@ class PtbWindow(object):
         else:
             self._update_background(background.ChosenBackground(choices, selected))
 
-        pygame.display.update()
+        self._update_foreground(None)
+        self._render()
 
     def show_image(self, pil_image=None, pos=CENTER):
         """Show PIL image as it (no resize).
         """
-        if not pil_image:
-            # Clear the currently displayed image
-            if self._current_foreground:
-                self._buffered_images.pop(id(self._current_foreground[0]), None)
-                self._current_foreground = None
-        else:
-            self._update_foreground(pil_image, pos, False)
-        pygame.display.update()
+        # Clear the currently displayed image if None
+        self._update_foreground(pil_image, pos, False)
+        self._render()
 
-    def show_work_in_progress(self):
-        """Show wait view.
+    def show_work_in_progress(self, step=0):
+        """Show wait view. The step is used to animate the dots at the
+        bottom of the screen while waiting.
         """
-        self._picture_number = (0, self._picture_number[1])
+        self._picture_number = (step % 4 + 1 if step else 0, 4)
         self._update_background(background.ProcessingBackground())
-        pygame.display.update()
+        self._update_foreground(None)
+        self._render()
 
-    def show_print(self, pil_image=None):
-        """Show print view.
+    def show_print(self, pil_image=None, queue_depth=None, busy=False):
+        """Show print view. If the number of print jobs in the queue is
+        given, the printing status (or the rejection of the request if the
+        printer is busy) is displayed instead of the question.
         """
         self._picture_number = (0, self._picture_number[1])
-        self._update_background(background.PrintBackground())
-        if pil_image:
-            self._update_foreground(pil_image, self.LEFT)
-        pygame.display.update()
+        if queue_depth is None:
+            self._update_background(background.PrintBackground())
+        else:
+            self._update_background(background.PrintingBackground(queue_depth, busy))
+        self._update_foreground(pil_image, self.LEFT)
+        self._render()
 
     def show_finished(self):
         """Show finished view.
         """
         self._picture_number = (0, self._picture_number[1])
         self._update_background(background.FinishedBackground())
-        pygame.display.update()
-
-
-    def show_finished_qr(self):
-        """Show finished view with QR code.
-        """
-
-        qr_image = Image.open("/home/pi/qrcode.png")
-        LOGGER.info("QR image mode: " + qr_image.mode)
-        if qr_image.mode != 'RGB':
-            if qr_image.mode == 'I':
-                from PIL import ImageMath
-                qr_image = ImageMath.eval('im/256', {'im': qr_image})
-            if qr_image.mode == 'P':
-                qr_image = qr_image.convert('RGBA')
-            else:
-                qr_image = qr_image.convert('RGB')
-
-        self._update_foreground(qr_image, self.RIGHT, False)
-        self._update_background(background.FinishedBackground())
-        pygame.display.update()
-
+        self._update_foreground(None)
+        self._render()
 
     @contextlib.contextmanager
     def flash(self, count):
@@ -249,9 +275,10 @@ class PtbWindow(object):
 
         for i in range(count):
             self.surface.fill((255, 255, 255))
-            if self._current_foreground:
+            image, image_rect = self._get_foreground()
+            if image:
                 # Flash only the background, keep forground at the top
-                self._update_foreground(*self._current_foreground)
+                self.surface.blit(image, image_rect)
             pygame.display.update()
             pygame.event.pump()
             time.sleep(0.02)
@@ -272,9 +299,7 @@ class PtbWindow(object):
 
         self._picture_number = (current_nbr, total_nbr)
         self._update_background(background.CaptureBackground())
-        if self._current_foreground:
-            self._update_foreground(*self._current_foreground)
-        pygame.display.update()
+        self._render()
 
     def toggle_fullscreen(self):
         """Set window to full screen or initial size.
@@ -288,4 +313,5 @@ class PtbWindow(object):
             pygame.mouse.set_visible(False)
             self.surface = pygame.display.set_mode(self.size, pygame.FULLSCREEN)
 
+        pictures.preload_images(self.size)
         self.update()
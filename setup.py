@@ -47,7 +47,7 @@ def main():
         package_data={
             'pibooth': ['*.ini'],
             'pibooth.fonts': ['*.ttf'],
-            'pibooth.pictures': ['*/*.png'],
+            'pibooth.pictures': ['*/*.png', '*.json'],
         },
         include_package_data=True,
         install_requires=[
@@ -57,7 +57,11 @@ def main():
             'Pygame',
             'gphoto2',
             'pycups',
+            'futures;python_version<"3.2"',
         ],
+        extras_require={
+            'qrcode': ['qrcode'],  # Display the QR code of the uploaded pictures
+        },
         options={
             'bdist_wheel':
                 {'universal': True}
@@ -10,6 +10,12 @@ import time
 import shutil
 
 
+class PiRenderer(object):
+
+    def update(self, source):
+        print("Mock: update overlay")
+
+
 class PiCamera(object):
 
     def __init__(self):
@@ -21,6 +27,7 @@ class PiCamera(object):
 
     def add_overlay(self, *args, **kwargs):
         print("Mock: add overlay")
+        return PiRenderer()
 
     def remove_overlay(self, *args, **kwargs):
         print("Mock: remove overlay")
@@ -29,9 +36,13 @@ class PiCamera(object):
         print("Mock: stop preview")
         self.preview = None
 
-    def capture(self, filename):
+    def capture(self, output, format=None):
         print("Mock: capture picture")
-        shutil.copy2(os.path.join(os.path.dirname(__file__), 'capture.png'), filename)
+        if hasattr(output, 'write'):
+            with open(os.path.join(os.path.dirname(__file__), 'capture.png'), 'rb') as fp:
+                output.write(fp.read())
+        else:
+            shutil.copy2(os.path.join(os.path.dirname(__file__), 'capture.png'), output)
         time.sleep(0.5)
 
     def close(self, *args, **kwargs):